@@ -7,3 +7,6 @@ from django.apps import AppConfig
 class FlexHoursConfig(AppConfig):
     name = "flex_hours"
     verbose_name = "Flex hours"
+
+    def ready(self):
+        import flex_hours.signals  # pylint:disable=unused-variable
@@ -1,3 +1,4 @@
+import bisect
 import datetime
 from collections import defaultdict
 
@@ -10,47 +11,83 @@ from flex_hours.models import FlexTimeCorrection, WorkContract
 from invoices.models import Event, HourEntry
 
 
+class ContractIndex(object):
+    """Per-user sorted index of work contract date ranges
+
+    Overlapping and adjacent contracts are merged, so each user has a list of non-overlapping intervals, and lookups are a binary search over that user's contracts only.
+    """
+
+    def __init__(self, contracts):
+        intervals = defaultdict(list)
+        for contract in sorted(contracts, key=lambda contract: (contract.user.email, contract.start_date)):
+            user_intervals = intervals[contract.user.email]
+            if user_intervals and contract.start_date <= user_intervals[-1][1] + datetime.timedelta(days=1):
+                user_intervals[-1][1] = max(user_intervals[-1][1], contract.end_date)
+            else:
+                user_intervals.append([contract.start_date, contract.end_date])
+        self.starts = {email: [start for start, _ in user_intervals] for email, user_intervals in intervals.items()}
+        self.ends = {email: [end for _, end in user_intervals] for email, user_intervals in intervals.items()}
+
+    def __contains__(self, email):
+        return email in self.starts
+
+    def find_gap(self, email, date):
+        """Return None if date is covered by a contract, or an identifier of the gap between contracts otherwise
+
+        The identifier is the index of the preceding contract (-1 before the first one), so uncovered dates in the same gap share the identifier.
+        """
+        position = bisect.bisect_right(self.starts.get(email, []), date) - 1
+        if position >= 0 and date <= self.ends[email][position]:
+            return None
+        return position
+
+
+def find_coverage_gaps(contract_index, hour_markings):
+    """Yield (email, first_date, last_date, days) for each contract gap with hour markings
+
+    hour_markings must be (email, date) pairs ordered by email and date. They are consumed one by one, so memory use does not depend on the number of markings.
+    """
+    current_gap = None
+    for email, date in hour_markings:
+        gap = contract_index.find_gap(email, date)
+        if gap is None:
+            continue
+        if current_gap and current_gap[0] == email and current_gap[1] == gap:
+            current_gap[3] = date
+            current_gap[4] += 1
+            continue
+        if current_gap:
+            yield current_gap[0], current_gap[2], current_gap[3], current_gap[4]
+        current_gap = [email, gap, date, date, 1]
+    if current_gap:
+        yield current_gap[0], current_gap[2], current_gap[3], current_gap[4]
+
+
 class Command(BaseCommand):
     help = "Check contract information"
 
     def handle(self, *args, **options):
         errors = []
-        work_contracts = WorkContract.objects.select_related("user")
-        per_user_contracts = defaultdict(list)
-        for contract in work_contracts:
-            per_user_contracts[contract.user.email].append(contract)
-        flex_time_corrections = FlexTimeCorrection.objects.order_by("date")  # Important to order by date for "start_date_by_user" collection
+        contract_index = ContractIndex(WorkContract.objects.select_related("user"))
+        flex_time_corrections = FlexTimeCorrection.objects.select_related("user").order_by("date")  # Important to order by date for "start_date_by_user" collection
         start_date_by_user = {}
         for correction in flex_time_corrections:
             if correction.set_to is not None:  # can be 0
                 start_date_by_user[correction.user.email] = correction.date
         for correction in flex_time_corrections:
-            if correction.user.email not in per_user_contracts:
+            if correction.user.email not in contract_index:
                 errors.append(f"Flex saldo correction ({correction}) for user {correction.user.email} but no contracts defined.")
                 continue
-            if correction.adjust_by is not None:
-                for contract in per_user_contracts[correction.user.email]:
-                    if contract.start_date <= correction.date <= contract.end_date:
-                        break
-                else:
-                    if correction.date < start_date_by_user[correction.user.email]:
-                        errors.append(f"Flex saldo adjustment ({correction}) for user {correction.user.email} but no valid contract defined.")
-
-        hour_entries = HourEntry.objects.exclude(user_m=None).filter(date__gte=datetime.datetime(2017, 10, 1)).values("user_m__email", "date").order_by("user_m__email", "date").distinct()
-        users_with_no_contracts = set()
-        for entry in hour_entries:
-            if entry["user_m__email"] in users_with_no_contracts:
-                continue
-            if entry["user_m__email"] not in per_user_contracts:
-                errors.append("No contract for {} ({})".format(entry["user_m__email"], entry["date"]))
-                users_with_no_contracts.add(entry["user_m__email"])
-                continue
-            for contract in work_contracts:
-                if contract.start_date <= entry["date"] <= contract.end_date:
-                    break
+            if correction.adjust_by is not None and contract_index.find_gap(correction.user.email, correction.date) is not None:
+                if correction.date < start_date_by_user[correction.user.email]:
+                    errors.append(f"Flex saldo adjustment ({correction}) for user {correction.user.email} but no valid contract defined.")
+
+        hour_markings = HourEntry.objects.exclude(user_m=None).filter(date__gte=datetime.datetime(2017, 10, 1)).values_list("user_m__email", "date").order_by("user_m__email", "date").distinct().iterator()
+        for email, first_date, last_date, days in find_coverage_gaps(contract_index, hour_markings):
+            if first_date == last_date:
+                errors.append(f"No contract for {email} ({first_date})")
             else:
-                errors.append("No contract for {} ({})".format(entry["user_m__email"], entry["date"]))
-                users_with_no_contracts.add(entry["user_m__email"])
+                errors.append(f"No contract for {email} between {first_date} and {last_date} ({days} days with hour markings)")
 
         message = "Following errors with flex hour contracts were found:\n"
         for error in errors:
@@ -1,10 +1,8 @@
-import json
-
-import redis
-from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
+from invoices.job_queue import queue_job
+
 
 class Command(BaseCommand):
     help = "Queue notifications flex saldos"
@@ -20,8 +18,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         now = timezone.now()
         if options.get("force") or now.isoweekday() == 3 and now.day <= 7:
-            redis_client = redis.from_url(settings.REDIS)
-            redis_client.publish("request-refresh", json.dumps({"type": "slack-flex-saldo-notification"}))
+            queue_job({"type": "slack-flex-saldo-notification"})
             self.stdout.write(self.style.SUCCESS(f"Successfully queued flex saldo notifications."))
         else:
             self.stdout.write("No force option specified, and it is not the first Wednesday of the month - notifications not queued.")
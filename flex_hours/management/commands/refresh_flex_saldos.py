@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from flex_hours.utils import refresh_flex_saldo_snapshots
+
+
+class Command(BaseCommand):
+    help = "Precalculate cached flex saldos for all active users. Run this nightly, as cached saldos are valid only for a single day."
+
+    def handle(self, *args, **options):
+        results = refresh_flex_saldo_snapshots()
+        self.stdout.write(self.style.SUCCESS(f"Successfully refreshed flex saldos for {len(results)} users."))
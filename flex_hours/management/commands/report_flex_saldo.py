@@ -3,7 +3,7 @@ import datetime
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from flex_hours.utils import FlexHourException, calculate_flex_saldo
+from flex_hours.utils import FlexHourException, calculate_flex_saldos
 from invoices.models import TenkfUser
 
 
@@ -29,11 +29,12 @@ class Command(BaseCommand):
             end_date = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
 
         users = []
-        for user in TenkfUser.objects.filter(archived=False):
-            try:
-                flex_info = calculate_flex_saldo(user, end_date, ignore_events=options.get("ignore_events", False))
-            except FlexHourException as error:
-                self.stdout.write(self.style.NOTICE(f"Unable to calculate the report for {user}: {error}"))
+        people = list(TenkfUser.objects.filter(archived=False))
+        flex_saldos = calculate_flex_saldos(people, end_date, ignore_events=options.get("ignore_events", False))
+        for user in people:
+            flex_info = flex_saldos[user.guid]
+            if isinstance(flex_info, FlexHourException):
+                self.stdout.write(self.style.NOTICE(f"Unable to calculate the report for {user}: {flex_info}"))
                 continue
             users.append((flex_info["person"].email, flex_info["cumulative_saldo"]))
         users = sorted(users, key=lambda k: k[1])
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from flex_hours.models import FlexTimeCorrection, WorkContract
+from flex_hours.utils import invalidate_flex_saldos
+
+
+@receiver(post_save, sender=WorkContract)
+@receiver(post_delete, sender=WorkContract)
+@receiver(post_save, sender=FlexTimeCorrection)
+@receiver(post_delete, sender=FlexTimeCorrection)
+def invalidate_user_flex_saldo(sender, instance, **kwargs):  # pylint:disable=unused-argument
+    invalidate_flex_saldos([instance.user_id])
@@ -0,0 +1,99 @@
+import datetime
+
+from django.test import SimpleTestCase
+
+from flex_hours.management.commands.check_contracts import ContractIndex, find_coverage_gaps
+from flex_hours.models import WorkContract
+from invoices.models import TenkfUser
+
+
+def day(month, day_of_month):
+    return datetime.date(2018, month, day_of_month)
+
+
+def contract(email, start_date, end_date):
+    return WorkContract(user=TenkfUser(email=email), start_date=start_date, end_date=end_date)
+
+
+def markings(email, first_date, last_date):
+    return [(email, first_date + datetime.timedelta(days=i)) for i in range((last_date - first_date).days + 1)]
+
+
+class ContractIndexTest(SimpleTestCase):
+    def test_covered_dates(self):
+        index = ContractIndex([contract("a@example.com", day(1, 1), day(1, 31))])
+        self.assertIsNone(index.find_gap("a@example.com", day(1, 1)))
+        self.assertIsNone(index.find_gap("a@example.com", day(1, 15)))
+        self.assertIsNone(index.find_gap("a@example.com", day(1, 31)))
+
+    def test_gap_before_first_and_after_last_contract(self):
+        index = ContractIndex([contract("a@example.com", day(2, 1), day(2, 28))])
+        self.assertEqual(index.find_gap("a@example.com", day(1, 31)), -1)
+        self.assertEqual(index.find_gap("a@example.com", day(3, 1)), 0)
+
+    def test_adjacent_contracts_are_merged(self):
+        index = ContractIndex([
+            contract("a@example.com", day(2, 1), day(2, 28)),
+            contract("a@example.com", day(1, 1), day(1, 31)),
+        ])
+        self.assertEqual(index.starts["a@example.com"], [day(1, 1)])
+        self.assertEqual(index.ends["a@example.com"], [day(2, 28)])
+
+    def test_overlapping_contracts_are_merged(self):
+        index = ContractIndex([
+            contract("a@example.com", day(1, 1), day(3, 31)),
+            contract("a@example.com", day(2, 1), day(2, 28)),
+            contract("a@example.com", day(3, 15), day(4, 30)),
+        ])
+        self.assertEqual(index.starts["a@example.com"], [day(1, 1)])
+        self.assertEqual(index.ends["a@example.com"], [day(4, 30)])
+
+    def test_gap_between_contracts(self):
+        index = ContractIndex([
+            contract("a@example.com", day(1, 1), day(1, 31)),
+            contract("a@example.com", day(3, 1), day(3, 31)),
+        ])
+        self.assertEqual(index.find_gap("a@example.com", day(2, 1)), 0)
+        self.assertEqual(index.find_gap("a@example.com", day(2, 28)), 0)
+        self.assertIsNone(index.find_gap("a@example.com", day(3, 1)))
+        self.assertEqual(index.find_gap("a@example.com", day(4, 1)), 1)
+
+    def test_open_ended_contract(self):
+        index = ContractIndex([contract("a@example.com", day(1, 1), datetime.date(2099, 12, 31))])
+        self.assertIsNone(index.find_gap("a@example.com", datetime.date(2050, 1, 1)))
+
+    def test_users_are_indexed_separately(self):
+        index = ContractIndex([contract("a@example.com", day(1, 1), day(1, 31))])
+        self.assertIn("a@example.com", index)
+        self.assertNotIn("b@example.com", index)
+        self.assertEqual(index.find_gap("b@example.com", day(1, 15)), -1)
+
+
+class FindCoverageGapsTest(SimpleTestCase):
+    def test_no_gaps(self):
+        index = ContractIndex([contract("a@example.com", day(1, 1), day(1, 31))])
+        self.assertEqual(list(find_coverage_gaps(index, markings("a@example.com", day(1, 1), day(1, 31)))), [])
+
+    def test_gaps_at_start_and_end_of_range(self):
+        index = ContractIndex([contract("a@example.com", day(1, 10), day(1, 20))])
+        gaps = list(find_coverage_gaps(index, markings("a@example.com", day(1, 1), day(1, 31))))
+        self.assertEqual(gaps, [
+            ("a@example.com", day(1, 1), day(1, 9), 9),
+            ("a@example.com", day(1, 21), day(1, 31), 11),
+        ])
+
+    def test_gap_between_contracts(self):
+        index = ContractIndex([
+            contract("a@example.com", day(1, 1), day(1, 31)),
+            contract("a@example.com", day(3, 1), day(3, 31)),
+        ])
+        gaps = list(find_coverage_gaps(index, markings("a@example.com", day(1, 30), day(3, 2))))
+        self.assertEqual(gaps, [("a@example.com", day(2, 1), day(2, 28), 28)])
+
+    def test_gaps_are_reported_per_user(self):
+        index = ContractIndex([contract("a@example.com", day(1, 1), day(1, 31))])
+        hour_markings = [("a@example.com", day(1, 5)), ("a@example.com", day(2, 5)), ("b@example.com", day(1, 5)), ("b@example.com", day(1, 6))]
+        self.assertEqual(list(find_coverage_gaps(index, hour_markings)), [
+            ("a@example.com", day(2, 5), day(2, 5), 1),
+            ("b@example.com", day(1, 5), day(1, 6), 2),
+        ])
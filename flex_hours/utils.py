@@ -1,10 +1,11 @@
 import datetime
 import json
 import pickle
+from collections import defaultdict
 
 import dateutil.rrule
+import redis
 from django.conf import settings
-from django.core.cache import cache
 from django.db.models import Q, Sum
 from django.template.loader import render_to_string
 from django.urls import reverse
@@ -12,9 +13,15 @@ from django.utils.dateparse import parse_date, parse_datetime
 
 from flex_hours.models import FlexTimeCorrection, PublicHoliday, WorkContract
 from invoices.models import Event, HourEntry, TenkfUser
-from invoices.slack import slack
+from invoices.slack_delivery import SlackOutbox, send_slack_notifications
 from invoices.tenkfeet_api import TenkFeetApi
 
+redis_client = redis.from_url(settings.REDIS)  # pylint:disable=invalid-name
+
+HOLIDAYS_VERSION_KEY = "public-holidays-version"
+KIKY_PROJECT_NAME = "KIKY - Make Finland Great again"
+_holiday_calendar = {}  # Process-local copy of the shared holiday calendar: {"version": ..., "holidays": {date: name}}
+
 
 class FlexHourException(Exception):
     pass
@@ -33,11 +40,13 @@ def send_flex_saldo_notifications(year, month):
     previous_month = (end_date - datetime.timedelta(days=32))
 
     c = 0
-    for user in TenkfUser.objects.all():
-        try:
-            flex_info = calculate_flex_saldo(user, end_date, only_active=True)
-        except FlexHourException as error:
-            print(f"Unable to calculate the report for {user}: {error}")
+    outbox = SlackOutbox("flex", f"{year}-{month:02d}")
+    users = list(TenkfUser.objects.all())
+    flex_saldos = calculate_flex_saldos(users, end_date, only_active=True)
+    for user in users:
+        flex_info = flex_saldos[user.guid]
+        if isinstance(flex_info, FlexHourException):
+            print(f"Unable to calculate the report for {user}: {flex_info}")
             continue
         if not flex_info.get("active", True):
             continue
@@ -67,12 +76,14 @@ def send_flex_saldo_notifications(year, month):
             }
             if user.slack_id:
                 c += 1
-                slack.chat.post_message(user.slack_id, attachments=[attachment], as_user="finance-bot")
+                outbox.post_message(user.slack_id, user.guid, attachments=[attachment])
                 for admin in settings.SLACK_NOTIFICATIONS_ADMIN:
-                    slack.chat.post_message(admin, text=f"Following message was sent to {user.full_name}:", attachments=[attachment], as_user="finance-bot")
+                    outbox.post_message(admin, f"{user.guid}:admin", text=f"Following message was sent to {user.full_name}:", attachments=[attachment])
             else:
                 print(f"Unable to send flex saldo notification to {user.guid} - no slack ID available.")
-    Event(event_type="send_flex_saldo_notifications", succeeded=True, message=f"Sent {c} flex saldo notifications").save()
+    outbox.enqueue()
+    sent_count, failed_count = send_slack_notifications("flex")
+    Event(event_type="send_flex_saldo_notifications", succeeded=failed_count == 0, message=f"Created {c} flex saldo notifications. Sent {sent_count} Slack messages, {failed_count} failed.").save()
 
 
 def fetch_contract(contracts, current_day):
@@ -134,10 +145,13 @@ def find_last_process_date(data_list, contracts, today):
     return last_process_day
 
 
-def calculate_kiky_stats(person, contracts, first_process_day, last_process_day):
-    hours = HourEntry.objects.exclude(status="Unsubmitted").filter(user_m=person).filter(date__gte=datetime.date(2017, 9, 1)).filter(invoice__project_m__name="KIKY - Make Finland Great again").aggregate(Sum("incurred_hours"))["incurred_hours__sum"]
-    if hours is None:
-        hours = 0
+def fetch_kiky_hours(people):
+    """Return {user_guid: KIKY hours done} for given people, using a single grouped query"""
+    kiky_entries = HourEntry.objects.exclude(status="Unsubmitted").filter(user_m__in=people).filter(date__gte=datetime.date(2017, 9, 1)).filter(invoice__project_m__name=KIKY_PROJECT_NAME)
+    return {item["user_m"]: item["hours"] for item in kiky_entries.values("user_m").order_by("user_m").annotate(hours=Sum("incurred_hours"))}
+
+
+def calculate_kiky_stats(hours, contracts, first_process_day, last_process_day):
     first_process_day = max(datetime.date(2017, 11, 1), first_process_day.replace(day=1))
     months_list = list(dateutil.rrule.rrule(dateutil.rrule.MONTHLY, dtstart=first_process_day, until=last_process_day))
     deduction = 0
@@ -160,41 +174,156 @@ def calculate_kiky_stats(person, contracts, first_process_day, last_process_day)
     }
 
 
-def get_holidays(today):
-    cache_key = f"holidays-{today:%Y-%m-%d}"
-    holidays = cache.get(cache_key)
+def get_holidays():
+    """Return all public holidays as {date: name}
+
+    The calendar is stored in redis without expiration, and shared by all web and worker processes. Each process keeps its own copy until sync_public_holidays changes something and bumps the version.
+    """
+    version = int(redis_client.get(HOLIDAYS_VERSION_KEY) or 0)
+    if _holiday_calendar.get("version") == version:
+        return _holiday_calendar["holidays"]
+    cache_key = f"public-holidays-{version}"
+    holidays = redis_client.get(cache_key)
     if holidays:
-        return pickle.loads(holidays)
-    holidays = {k.date: k.name for k in PublicHoliday.objects.filter(date__lte=today)}
-    cache.set(cache_key, pickle.dumps(holidays), 10)
+        holidays = pickle.loads(holidays)
+    else:
+        holidays = {k.date: k.name for k in PublicHoliday.objects.all()}
+        redis_client.set(cache_key, pickle.dumps(holidays))
+    _holiday_calendar.update(version=version, holidays=holidays)
     return holidays
 
 
-def calculate_flex_saldo(person, flex_last_day=None, only_active=False, ignore_events=False):
+def invalidate_holidays():
+    version = redis_client.incr(HOLIDAYS_VERSION_KEY)
+    redis_client.delete(f"public-holidays-{version - 1}")
+
+
+def fetch_hour_markings(start_dates, today):
+    """Fetch per-day hour sums for flex calculations
+
+    start_dates is {user_guid: first date to include}. Returns {user_guid: [per-day dicts ordered by date]}, using a single query for all users.
+    """
+    hour_markings = defaultdict(list)
+    if not start_dates:
+        return hour_markings
+    data_list = (HourEntry.objects.exclude(status="Unsubmitted").filter(user_m__in=list(start_dates.keys())).filter(date__gte=min(start_dates.values())).exclude(date__gte=today).values("user_m", "date").order_by("user_m", "date")
+                 .annotate(incurred_working_hours=Sum("incurred_hours", filter=~Q(phase_name__icontains="overtime") & Q(leave_type="[project]") & ~Q(invoice__project_m__name=KIKY_PROJECT_NAME)))
+                 .annotate(incurred_leave_hours=Sum("incurred_hours", filter=~Q(leave_type="Flex time Leave") & ~Q(leave_type="[project]") & ~Q(leave_type="Unpaid leave")))
+                 .annotate(incurred_unpaid_leave=Sum("incurred_hours", filter=Q(leave_type="Unpaid leave")))
+                 .annotate(incurred_overtime=Sum("incurred_hours", filter=Q(phase_name__icontains="overtime"))))
+    for item in data_list:
+        if item["date"] >= start_dates[item["user_m"]]:
+            hour_markings[item["user_m"]].append(item)
+    return hour_markings
+
+
+def calculate_flex_saldos(people, flex_last_day=None, only_active=False, ignore_events=False):
+    """Calculate flex saldos for multiple people with a constant number of queries
+
+    Returns {person.guid: context}. If the calculation fails for a person, the value is the FlexHourException instead of the context.
+    """
     if not flex_last_day:
         flex_last_day = datetime.date.today() - datetime.timedelta(days=1)  # The default is to exclude today to have stable flex saldo (assuming everyone marks hours daily)
-    contracts = WorkContract.objects.filter(user=person)
-    if ignore_events:
-        events = []
-    else:
-        events = FlexTimeCorrection.objects.filter(user=person)
     today = datetime.date.today()
+    people = list(people)
+
+    contracts_by_user = defaultdict(list)
+    for contract in WorkContract.objects.filter(user__in=people):
+        contracts_by_user[contract.user_id].append(contract)
+    events_by_user = defaultdict(list)
+    if not ignore_events:
+        for event in FlexTimeCorrection.objects.filter(user__in=people):
+            events_by_user[event.user_id].append(event)
+
+    results = {}
+    start_dates = {}
+    for person in people:
+        contracts = contracts_by_user[person.guid]
+        if only_active and not fetch_contract(contracts, flex_last_day):
+            results[person.guid] = {"active": False}
+            continue
+        try:
+            start_dates[person.guid] = find_first_process_date(events_by_user[person.guid], contracts)
+        except FlexHourException as error:
+            results[person.guid] = error
+
+    holidays = get_holidays()
+    hour_markings = fetch_hour_markings({guid: start_date for guid, (start_date, _) in start_dates.items()}, today)
+    kiky_hours = fetch_kiky_hours(list(start_dates.keys()))
+    for person in people:
+        if person.guid not in start_dates:
+            continue
+        start_hour_markings_from_date, cumulative_saldo = start_dates[person.guid]
+        try:
+            results[person.guid] = calculate_person_flex_saldo(person, contracts_by_user[person.guid], events_by_user[person.guid], start_hour_markings_from_date, cumulative_saldo, hour_markings[person.guid], kiky_hours.get(person.guid, 0), holidays, flex_last_day)
+        except FlexHourException as error:
+            results[person.guid] = error
+    return results
+
+
+def calculate_flex_saldo(person, flex_last_day=None, only_active=False, ignore_events=False):
+    result = calculate_flex_saldos([person], flex_last_day, only_active, ignore_events)[person.guid]
+    if isinstance(result, FlexHourException):
+        raise result
+    return result
+
 
-    if only_active:
-        if not fetch_contract(contracts, flex_last_day):
-            return {"active": False}
+def get_cached_flex_saldos(people, only_active=False, calculate_missing=True):
+    """Return calculate_flex_saldos results, served from redis when possible
+
+    Cached results are keyed by the per-user data version (see invalidate_flex_saldos), the public holiday version and the last processed day, so they never need to be explicitly deleted. Only people without a fresh cached result are calculated. With calculate_missing=False, people without a fresh cached result are left out of the results.
+    """
+    flex_last_day = datetime.date.today() - datetime.timedelta(days=1)
+    people = list(people)
+    versions = redis_client.mget([HOLIDAYS_VERSION_KEY] + [f"flex-version-{person.guid}" for person in people])
+    holidays_version = int(versions[0] or 0)
+    cache_keys = {person.guid: f"flex-saldo-{person.guid}-{int(version or 0)}-{holidays_version}-{flex_last_day:%Y-%m-%d}-{only_active}" for person, version in zip(people, versions[1:])}
+    results = {}
+    missing_people = []
+    for person, cached_data in zip(people, redis_client.mget(list(cache_keys.values()))):
+        if cached_data:
+            results[person.guid] = pickle.loads(cached_data)
+        else:
+            missing_people.append(person)
+    if missing_people and calculate_missing:
+        calculated = calculate_flex_saldos(missing_people, flex_last_day, only_active=only_active)
+        pipe = redis_client.pipeline(transaction=False)
+        for guid, result in calculated.items():
+            pipe.set(cache_keys[guid], pickle.dumps(result), ex=60 * 60 * 24)
+        pipe.execute()
+        results.update(calculated)
+    return results
+
+
+def get_cached_flex_saldo(person, only_active=False):
+    result = get_cached_flex_saldos([person], only_active)[person.guid]
+    if isinstance(result, FlexHourException):
+        raise result
+    return result
+
+
+def refresh_flex_saldo_snapshots():
+    """Precalculate cached flex saldos for all active users
+
+    Run nightly and after hour entry updates, so that Slack commands can be answered from the cache.
+    """
+    people = TenkfUser.objects.filter(archived=False)
+    results = get_cached_flex_saldos(people, only_active=True)
+    Event(event_type="refresh_flex_saldo_snapshots", succeeded=True, message=f"Refreshed flex saldos for {len(results)} users").save()
+    return results
 
-    # Find the first date
-    start_hour_markings_from_date, cumulative_saldo = find_first_process_date(events, contracts)
 
-    holidays = get_holidays(today)
+def invalidate_flex_saldos(user_guids):
+    """Bump flex data versions for given users, making their cached flex saldos stale"""
+    if not user_guids:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for user_guid in user_guids:
+        pipe.incr(f"flex-version-{user_guid}")
+    pipe.execute()
 
-    data_list = list(HourEntry.objects.exclude(status="Unsubmitted").filter(user_m=person).filter(date__gte=start_hour_markings_from_date).exclude(date__gte=today).values("date").order_by("date")
-                     .annotate(incurred_working_hours=Sum("incurred_hours", filter=~Q(phase_name__icontains="overtime") & Q(leave_type="[project]") & ~Q(invoice__project_m__name="KIKY - Make Finland Great again")))
-                     .annotate(incurred_leave_hours=Sum("incurred_hours", filter=~Q(leave_type="Flex time Leave") & ~Q(leave_type="[project]") & ~Q(leave_type="Unpaid leave")))
-                     .annotate(incurred_unpaid_leave=Sum("incurred_hours", filter=Q(leave_type="Unpaid leave")))
-                     .annotate(incurred_overtime=Sum("incurred_hours", filter=Q(phase_name__icontains="overtime"))))
 
+def calculate_person_flex_saldo(person, contracts, events, start_hour_markings_from_date, cumulative_saldo, data_list, kiky_hours, holidays, flex_last_day):  # pylint:disable=too-many-arguments
     hour_markings_data = {k["date"]: k for k in data_list}
 
     last_process_day = find_last_process_date(data_list, contracts, flex_last_day)
@@ -287,7 +416,7 @@ def calculate_flex_saldo(person, flex_last_day=None, only_active=False, ignore_e
     if month_entry.get("month"):
         per_month_stats.append(month_entry)
     per_month_stats.reverse()
-    kiky_stats = calculate_kiky_stats(person, contracts, start_hour_markings_from_date, last_process_day)
+    kiky_stats = calculate_kiky_stats(kiky_hours, contracts, start_hour_markings_from_date, last_process_day)
 
     if per_month_stats:
         months = reversed([["{:%Y-%m}".format(entry["month"]), entry["cumulative_saldo"]] for entry in per_month_stats] + [["Date", "Flex saldo (h)"]])
@@ -310,7 +439,8 @@ def calculate_flex_saldo(person, flex_last_day=None, only_active=False, ignore_e
     return context
 
 
-def sync_public_holidays():
+def sync_public_holidays(holidays=None):
+    """Sync public holidays from 10000ft. holidays is the upstream holiday list, if already fetched"""
     def process_10000ft_holiday(holiday):
         holiday["date"] = parse_date(holiday["date"])
         holiday["created_at"] = parse_datetime(holiday["created_at"])
@@ -318,8 +448,9 @@ def sync_public_holidays():
         del holiday["id"]
         return holiday
 
-    tenkfeet_api = TenkFeetApi(settings.TENKFEET_AUTH)
-    holidays = [process_10000ft_holiday(holiday) for holiday in tenkfeet_api.fetch_holidays()]
+    if holidays is None:
+        holidays = TenkFeetApi(settings.TENKFEET_AUTH).fetch_holidays()
+    holidays = [process_10000ft_holiday(dict(holiday)) for holiday in holidays]
     stored_holidays = {holiday.date: holiday for holiday in PublicHoliday.objects.all()}
     deleted = added = updated = 0
     for holiday in holidays:
@@ -341,4 +472,6 @@ def sync_public_holidays():
     if removed_holidays:
         print("Deleting {}".format(", ".join([holiday.strftime("%Y-%m-%d") for holiday in removed_holidays])))
         deleted, _ = PublicHoliday.objects.filter(date__in=removed_holidays).delete()
+    if added or updated or deleted:
+        invalidate_holidays()
     Event(event_type="sync_public_holidays", succeeded=True, message=f"Added {added}, updated {updated}, deleted {deleted}").save()
@@ -1,30 +1,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import json
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
-from django.http import HttpResponse, JsonResponse
+from django.core.paginator import InvalidPage, Paginator
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404, render
 
-from flex_hours.utils import FlexHourException, calculate_flex_saldo
+from flex_hours.utils import FlexHourException, get_cached_flex_saldo, get_cached_flex_saldos
 from invoices.models import TenkfUser
 
 
+def get_flex_json_summary(context):
+    if not context.get("active", True):
+        return {"flex_enabled": False}
+    monthly_saldos = reversed([month.get("cumulative_saldo", 0) for month in context["monthly_summary"]][0:12])
+    return {"monthly_saldos": list(monthly_saldos), "flex_enabled": True, "flex_hours": context["cumulative_saldo"], "kiky_saldo": context.get("kiky", {}).get("saldo")}
+
+
 def get_flex_hours_for_user(request, person, json_responses=False, only_active=False):
     try:
-        context = calculate_flex_saldo(person, only_active=only_active)
+        context = get_cached_flex_saldo(person, only_active=only_active)
         context.update({"max_minus": settings.FLEX_MAX_MINUS, "max_plus": settings.FLEX_MAX_PLUS})
     except FlexHourException as error:
         if json_responses:
             return JsonResponse({"flex_enabled": False})
         return render(request, "error.html", {"error": error, "message": "This is normal for flex hour calculations when some required information is missing. If this is your page, please contact HR to get this fixed."})
     if json_responses:
-        if not context.get("active", True):
-            return HttpResponse(json.dumps({"flex_enabled": False}), content_type="application/json")
-        monthly_saldos = reversed([month.get("cumulative_saldo", 0) for month in context["monthly_summary"]][0:12])
-        return JsonResponse({"monthly_saldos": list(monthly_saldos), "flex_enabled": True, "flex_hours": context["cumulative_saldo"], "kiky_saldo": context.get("kiky", {}).get("saldo")})
+        return JsonResponse(get_flex_json_summary(context))
     return render(request, "flex_hours/details.html", context)
 
 
@@ -34,6 +39,36 @@ def flex_overview(request):
     return render(request, "flex_hours/list.html", {"people": people, "max_minus": settings.FLEX_MAX_MINUS, "max_plus": settings.FLEX_MAX_PLUS})
 
 
+@permission_required("flex_hours.can_see_flex_saldos")
+def flex_overview_json(request):
+    """Flex saldo summaries for all non-archived people (or a page/selection of them) in a single response
+
+    Without ?page=, all people are returned. Results are served from the per-user flex saldo cache.
+    """
+    people = TenkfUser.objects.exclude(archived=True).order_by("guid")
+    if request.GET.get("users"):
+        try:
+            people = people.filter(guid__in=[uuid.UUID(guid) for guid in request.GET["users"].split(",")])
+        except ValueError:
+            return HttpResponseBadRequest("Invalid user ID")
+    only_active = request.GET.get("onlyActive", False) == "true"
+    if "page" in request.GET:
+        try:
+            page = Paginator(people, max(1, int(request.GET.get("per_page", 1000)))).page(request.GET["page"])
+        except (ValueError, InvalidPage):
+            return HttpResponseBadRequest("Invalid page")
+        page_number, num_pages, people = page.number, page.paginator.num_pages, page
+    else:
+        page_number, num_pages = 1, 1
+    flex_saldos = get_cached_flex_saldos(people, only_active=only_active)
+    data = {
+        "page": page_number,
+        "num_pages": num_pages,
+        "users": {str(guid): {"flex_enabled": False} if isinstance(context, FlexHourException) else get_flex_json_summary(context) for guid, context in flex_saldos.items()},
+    }
+    return JsonResponse(data)
+
+
 @login_required
 def person_flex_hours(request, user_guid):
     person = get_object_or_404(TenkfUser, guid=user_guid)
@@ -51,6 +51,9 @@ SESSION_COOKIE_SECURE = SECURE_SSL_REDIRECT  # https://docs.djangoproject.com/en
 CSRF_COOKIE_SECURE = SECURE_SSL_REDIRECT  # https://docs.djangoproject.com/en/2.0/ref/settings/#csrf-cookie-secure
 
 SLACK_NOTIFICATIONS_ADMIN = list(filter(len, os.environ.get("SLACK_NOTIFICATIONS_ADMIN", "").split(",")))
+SLACK_API_URL = os.environ.get("SLACK_API_URL", "https://slack.com/api/")  # Override to test notifications against a local fake Slack server
+SLACK_DELIVERY_WORKERS = int(os.environ.get("SLACK_DELIVERY_WORKERS", 4))
+HOUR_ENTRY_STAGING = os.environ.get("HOUR_ENTRY_STAGING", False) in (True, "True", "true")  # Load synced hour entries to a staging table before swapping them in. See invoices/syncing/staging.py
 DOMAIN = os.environ.get("DOMAIN")
 REDIRECT_OLD_DOMAIN = os.environ.get("REDIRECT_OLD_DOMAIN")
 REDIRECT_NEW_DOMAIN = os.environ.get("REDIRECT_NEW_DOMAIN")
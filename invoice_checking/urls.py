@@ -32,6 +32,7 @@ urlpatterns = [
     path("users", invoices.views.users_list, name="users_list"),
     path("users/charts", invoices.views.users_charts, name="users_charts"),
     path("users/flexhours", flex_hours.views.flex_overview, name="flex_overview"),
+    path("users/flexhours/json", flex_hours.views.flex_overview_json, name="flex_overview_json"),
     path("users/<uuid:user_guid>", invoices.views.person_overview, name="person_overview"),
     path("users/<uuid:user_guid>/<int:year>/<int:month>", invoices.views.person_details_month, name="person_month"),
     path("users/<uuid:user_guid>/flexhours", flex_hours.views.person_flex_hours, name="person_flex_hours"),
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from invoices.models import InvoiceFixedEntry, Project, ProjectFixedEntry, SlackChannel, TenkfUser
+from invoices.models import (BackfillChunk, InvoiceFixedEntry, Project, ProjectFixedEntry, QueuedJob, SlackChannel,
+                             SlackNotification, TenkfUser)
 
 
 class DeleteNotAllowedModelAdmin(admin.ModelAdmin):
@@ -52,3 +53,31 @@ class UserAdmin(DeleteNotAllowedModelAdmin):
 
 
 admin.site.register(TenkfUser, UserAdmin)
+
+
+class SlackNotificationAdmin(DeleteNotAllowedModelAdmin):
+    list_display = ("idempotency_key", "channel", "status", "attempts", "created_at", "sent_at")
+    list_filter = ("notification_type", "status")
+    search_fields = ("idempotency_key", "channel")
+    readonly_fields = ("idempotency_key", "notification_type", "channel", "text", "attachments", "attempts", "error", "created_at", "claimed_at", "sent_at")
+
+
+admin.site.register(SlackNotification, SlackNotificationAdmin)
+
+
+class BackfillChunkAdmin(admin.ModelAdmin):
+    list_display = ("backfill", "start_date", "end_date", "status", "entries_count", "finished_at")
+    list_filter = ("backfill", "status")
+    readonly_fields = ("backfill", "start_date", "end_date", "status", "entries_count", "error", "updated_at", "finished_at")
+
+
+admin.site.register(BackfillChunk, BackfillChunkAdmin)
+
+
+class QueuedJobAdmin(admin.ModelAdmin):
+    list_display = ("job_type", "start_date", "end_date", "status", "merged_jobs", "created_at", "started_at", "heartbeat_at", "finished_at")
+    list_filter = ("job_type", "status")
+    readonly_fields = ("job_type", "data", "start_date", "end_date", "status", "merged_jobs", "error", "created_at", "started_at", "heartbeat_at", "finished_at")
+
+
+admin.site.register(QueuedJob, QueuedJobAdmin)
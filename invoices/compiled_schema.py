@@ -0,0 +1,112 @@
+"""
+Fast validation for `schema` definitions.
+
+schema.Schema.validate is generic: it wraps each nested definition into new Schema objects, and for dicts tries every schema key against every data key. CompiledSchema turns the same definition into nested closures once, so large payloads (such as 10000ft time entries) are validated with plain type checks and dict lookups. Coercions (Use) are the same functions, so the results are identical.
+
+If the compiled validator rejects the data, the original Schema.validate is run to raise the usual SchemaError with a descriptive message.
+"""
+from schema import And, Or, Schema, SchemaError, Use
+
+
+class InvalidData(Exception):
+    pass
+
+
+def compile_validator(definition):  # pylint:disable=too-many-return-statements
+    """Return a function that validates data against a schema definition, raising InvalidData on failure"""
+    if isinstance(definition, Schema):
+        if definition._error or definition._ignore_extra_keys:  # pylint:disable=protected-access
+            return compile_fallback(definition)
+        return compile_validator(definition._schema)  # pylint:disable=protected-access
+    if isinstance(definition, Use):
+        return compile_use(definition._callable)  # pylint:disable=protected-access
+    if isinstance(definition, Or):
+        return compile_or([compile_validator(arg) for arg in definition._args])  # pylint:disable=protected-access
+    if isinstance(definition, And):
+        return compile_and([compile_validator(arg) for arg in definition._args])  # pylint:disable=protected-access
+    if isinstance(definition, type):
+        return compile_type(definition)
+    if type(definition) is dict and all(type(key) is str for key in definition):  # pylint:disable=unidiomatic-typecheck
+        return compile_dict({key: compile_validator(value) for key, value in definition.items()})
+    if type(definition) is list:  # pylint:disable=unidiomatic-typecheck
+        if len(definition) == 1:
+            return compile_list(compile_validator(definition[0]))
+        return compile_list(compile_or([compile_validator(item) for item in definition]))
+    return compile_fallback(Schema(definition))
+
+
+def compile_fallback(schema):
+    def validate(data):
+        try:
+            return schema.validate(data)
+        except SchemaError:
+            raise InvalidData()
+    return validate
+
+
+def compile_use(function):
+    def validate(data):
+        try:
+            return function(data)
+        except Exception:
+            raise InvalidData()
+    return validate
+
+
+def compile_or(validators):
+    def validate(data):
+        for validator in validators:
+            try:
+                return validator(data)
+            except InvalidData:
+                pass
+        raise InvalidData()
+    return validate
+
+
+def compile_and(validators):
+    def validate(data):
+        for validator in validators:
+            data = validator(data)
+        return data
+    return validate
+
+
+def compile_type(data_type):
+    def validate(data):
+        if isinstance(data, data_type):
+            return data
+        raise InvalidData()
+    return validate
+
+
+def compile_dict(validators):
+    keys = set(validators.keys())
+
+    def validate(data):
+        if not isinstance(data, dict) or data.keys() != keys:
+            raise InvalidData()
+        return type(data)((key, validators[key](value)) for key, value in data.items())
+    return validate
+
+
+def compile_list(validator):
+    def validate(data):
+        if not isinstance(data, list):
+            raise InvalidData()
+        return type(data)(validator(item) for item in data)
+    return validate
+
+
+class CompiledSchema(object):
+    """Drop-in replacement for schema.Schema with faster validate()"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.compiled = compile_validator(schema)
+
+    def validate(self, data):
+        try:
+            return self.compiled(data)
+        except InvalidData:
+            return self.schema.validate(data)
@@ -0,0 +1,169 @@
+"""
+Durable queue for background jobs.
+
+Jobs are stored to the QueuedJob table, so jobs queued while the worker (process_update_queue) is restarting are not lost. A job is acknowledged (marked as done or failed) only after it has been processed.
+
+Queued data updates with overlapping or adjacent date ranges are merged into a single job, as long as the merged range is at most MAX_MERGED_RANGE_LENGTH long. Queued jobs of other types are dropped if an identical job is already queued. This way, bursts of update requests result in a single sync.
+
+After a job has been stored, a message is published to the `request-refresh` redis channel to wake up the workers. The message only carries the job ID - workers also poll the table, so lost messages only delay processing.
+
+Multiple workers can process jobs concurrently. A worker claims a job with a conditional UPDATE, and holds a distributed lock (see invoices.locking) while processing it. The lock covers the job itself, and the resources the job writes to: each day of the date range of a data update, or the notification type. Jobs whose resources are locked by another worker are left in the queue, so overlapping syncs and duplicate notification runs do not run concurrently, while other jobs do.
+
+If a worker can not renew its lock in time (for example, redis is unavailable), another worker may acquire the same resources. Data updates check the lock before and at the end of the write transaction, and abort without committing if it was lost. Running jobs are queued again only after the worker has stopped updating QueuedJob.heartbeat_at, so a job is not run twice just because its lock expired.
+"""
+import datetime
+import json
+import logging
+
+import redis
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from invoices.locking import DistributedLock, get_date_range_lock_keys, is_locked
+from invoices.models import QueuedJob
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+redis_client = redis.from_url(settings.REDIS)  # pylint:disable=invalid-name
+
+JOB_QUEUE_CHANNEL = "request-refresh"
+MAX_MERGED_RANGE_LENGTH = datetime.timedelta(days=181)
+DATE_FORMAT = "%Y-%m-%d"
+JOB_LEASE = 60  # seconds. Locks and heartbeats of a crashed worker expire after this.
+CLAIM_CANDIDATES = 20  # Number of oldest queued jobs a worker tries to claim at once
+
+
+def queue_job(data):
+    """Store a job to the queue, and return the QueuedJob it was stored to (a new one, or an existing one it was merged to)
+
+    data is a JSON serializable dict with "type". Data updates also have "start_date" and "end_date" ("YYYY-MM-DD"), and optionally "force".
+    """
+    with transaction.atomic():
+        if data["type"] == "data-update":
+            job = queue_data_update(data)
+        else:
+            job = queue_unique_job(data)
+    transaction.on_commit(lambda: redis_client.publish(JOB_QUEUE_CHANNEL, job.id))
+    return job
+
+
+def queue_unique_job(data):
+    encoded_data = json.dumps(data, sort_keys=True)
+    job = QueuedJob.objects.select_for_update().filter(status="queued", job_type=data["type"], data=encoded_data).order_by("id").first()
+    if job:
+        logger.info("Identical job is already queued: %s", job)
+        job.merged_jobs += 1
+        job.save(update_fields=["merged_jobs"])
+        return job
+    return QueuedJob.objects.create(job_type=data["type"], data=encoded_data)
+
+
+def queue_data_update(data):
+    start_date = datetime.datetime.strptime(data["start_date"], DATE_FORMAT).date()
+    end_date = datetime.datetime.strptime(data["end_date"], DATE_FORMAT).date()
+    force = data.get("force", False)
+    merged_jobs = {}
+    while True:
+        # Jobs with overlapping or adjacent ranges. Merging extends the range, so this is repeated until nothing new is found.
+        candidates = QueuedJob.objects.select_for_update().filter(
+            status="queued",
+            job_type="data-update",
+            start_date__lte=end_date + datetime.timedelta(days=1),
+            end_date__gte=start_date - datetime.timedelta(days=1)
+        ).exclude(id__in=list(merged_jobs.keys())).order_by("id")
+        merged = False
+        for candidate in candidates:
+            merged_start_date = min(start_date, candidate.start_date)
+            merged_end_date = max(end_date, candidate.end_date)
+            if merged_end_date - merged_start_date > MAX_MERGED_RANGE_LENGTH:
+                continue
+            start_date, end_date = merged_start_date, merged_end_date
+            force = force or json.loads(candidate.data).get("force", False)
+            merged_jobs[candidate.id] = candidate
+            merged = True
+        if not merged:
+            break
+
+    merged_data = json.dumps({"type": "data-update", "force": force, "start_date": start_date.strftime(DATE_FORMAT), "end_date": end_date.strftime(DATE_FORMAT)}, sort_keys=True)
+    if not merged_jobs:
+        return QueuedJob.objects.create(job_type="data-update", data=merged_data, start_date=start_date, end_date=end_date)
+
+    # The oldest job is kept, so the merged job keeps its place in the queue.
+    job = merged_jobs.pop(min(merged_jobs.keys()))
+    job.data = merged_data
+    job.start_date = start_date
+    job.end_date = end_date
+    job.merged_jobs += 1 + sum(other_job.merged_jobs + 1 for other_job in merged_jobs.values())
+    job.save(update_fields=["data", "start_date", "end_date", "merged_jobs"])
+    QueuedJob.objects.filter(id__in=list(merged_jobs.keys())).delete()
+    logger.info("Merged data update %s - %s to %s", data["start_date"], data["end_date"], job)
+    return job
+
+
+def get_job_lock_key(job_id):
+    return f"lock-job-{job_id}"
+
+
+def get_job_lock_keys(job):
+    keys = [get_job_lock_key(job.id)]
+    if job.job_type == "data-update":
+        keys.extend(get_date_range_lock_keys(job.start_date, job.end_date))
+    elif job.job_type.endswith("-notification"):
+        keys.append(f"lock-{job.job_type}")
+    return keys
+
+
+def get_job_heartbeat(job_id):
+    def heartbeat():
+        try:
+            QueuedJob.objects.filter(id=job_id, status="running").update(heartbeat_at=timezone.now())
+        except DatabaseError as error:
+            logger.warning("Unable to update heartbeat for job %s: %s", job_id, error)
+        finally:
+            connection.close()  # Called from the lock renewal thread, which has its own database connection
+    return heartbeat
+
+
+def claim_next_job():
+    """Claim the oldest queued job whose locks are available, and return (job, lock), or None if there is nothing to process
+
+    The lock is renewed, and the heartbeat of the job updated, in the background until the lock is released with lock.release().
+    """
+    for job_id in QueuedJob.objects.filter(status="queued").order_by("id").values_list("id", flat=True)[:CLAIM_CANDIDATES]:
+        # Only one worker can move a job from queued to running.
+        if not QueuedJob.objects.filter(id=job_id, status="queued").update(status="running", started_at=timezone.now(), heartbeat_at=timezone.now()):
+            continue
+        # The job is read after claiming it, as other jobs may have been merged to it until then.
+        job = QueuedJob.objects.get(id=job_id)
+        lock = DistributedLock(get_job_lock_keys(job), lease=JOB_LEASE, heartbeat=get_job_heartbeat(job_id))
+        if lock.acquire():
+            return job, lock
+        logger.info("%s is locked by another worker - leaving it to the queue", job)
+        requeue_job(job)
+    return None
+
+
+def requeue_job(job):
+    """Move a claimed job back to the queue"""
+    QueuedJob.objects.filter(id=job.id, status="running").update(status="queued", started_at=None, heartbeat_at=None)
+
+
+def ack_job(job, error=None):
+    job.status = "failed" if error else "done"
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "finished_at"])
+
+
+def requeue_interrupted_jobs():
+    """Move jobs left in "running" state by an interrupted worker back to the queue, and return the number of these
+
+    Workers update the heartbeat of the jobs they are running, also when their lock can not be renewed, so jobs without a recent heartbeat and without a lock are not running anymore.
+    """
+    expired_before = timezone.now() - datetime.timedelta(seconds=JOB_LEASE)
+    running_job_ids = QueuedJob.objects.filter(status="running").filter(Q(heartbeat_at__lt=expired_before) | Q(heartbeat_at=None, started_at__lt=expired_before)).values_list("id", flat=True)
+    interrupted_job_ids = [job_id for job_id in running_job_ids if not is_locked(get_job_lock_key(job_id))]
+    if not interrupted_job_ids:
+        return 0
+    return QueuedJob.objects.filter(id__in=interrupted_job_ids, status="running").update(status="queued", started_at=None, heartbeat_at=None)
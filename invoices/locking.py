@@ -0,0 +1,156 @@
+"""
+Redis-based distributed locks with lease renewal.
+
+A DistributedLock holds a set of keys at once: either all keys are acquired, or none. Each key expires after `lease` seconds, so locks held by a crashed process are released automatically. While the lock is held, a background thread renews the lease every `lease / 3` seconds.
+
+If the lease could not be renewed in time (for example, redis was unavailable), other processes may have acquired the keys. The lock is then marked as lost. Call check() right before writes that must not overlap with other holders of the same keys - it raises LockLost instead of letting the write proceed.
+
+Use `with DistributedLock(keys):` to wait until all keys are available. Keys are acquired and renewed with optimistic (WATCH/MULTI) transactions, so no Lua scripting is required from the redis server.
+"""
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+import redis
+from django.conf import settings
+
+from invoices.utils import daterange
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+redis_client = redis.from_url(settings.REDIS)  # pylint:disable=invalid-name
+
+
+class LockLost(Exception):
+    pass
+
+
+def get_date_range_lock_keys(start_date, end_date):
+    """Return lock keys for each day between start_date and end_date, so locks for overlapping ranges conflict"""
+    return [f"lock-hour-entries-{day:%Y-%m-%d}" for day in daterange(start_date, end_date)]
+
+
+def get_invoice_month_lock_keys(start_date, end_date):
+    """Return lock keys for each month between start_date and end_date. Invoices are monthly, so these cover invoices of the date range."""
+    keys = []
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        keys.append(f"lock-invoice-stats-{month:%Y-%m}")
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return keys
+
+
+class DistributedLock(object):
+    def __init__(self, keys, lease=60, redis_instance=None, heartbeat=None):
+        self.keys = list(keys)
+        self.lease = lease
+        self.redis = redis_instance or redis_client
+        self.heartbeat = heartbeat  # Called from the renewal thread on each renewal interval, even if renewing fails
+        self.token = str(uuid.uuid4())
+        self.acquired = False
+        self.lost = False
+        self.renewed_at = None  # time.monotonic() before the latest successful acquire or renew
+        self.stop_renewal = threading.Event()
+        self.renewal_thread = None
+
+    def __str__(self):
+        if len(self.keys) > 2:
+            return f"{self.keys[0]} ... {self.keys[-1]} ({len(self.keys)} keys)"
+        return ", ".join(self.keys)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def wait(self, poll_interval=5):
+        """Acquire the lock, waiting until all keys are available"""
+        while not self.acquire():
+            logger.info("%s is locked by another process - waiting", self)
+            time.sleep(poll_interval)
+
+    def acquire(self):
+        """Try to acquire all keys without blocking. Returns True if the lock was acquired."""
+        started_at = time.monotonic()
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(*self.keys)
+                if any(pipe.mget(self.keys)):
+                    return False
+                pipe.multi()
+                for key in self.keys:
+                    pipe.set(key, self.token, px=int(self.lease * 1000))
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        self.acquired = True
+        self.lost = False
+        self.renewed_at = started_at
+        self.stop_renewal.clear()
+        self.renewal_thread = threading.Thread(target=self.renew_until_released, daemon=True)
+        self.renewal_thread.start()
+        return True
+
+    def renew(self):
+        """Extend the lease of all keys. Returns False if any of the keys is no longer held by this lock."""
+        started_at = time.monotonic()
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(*self.keys)
+                if any(value is None or value.decode() != self.token for value in pipe.mget(self.keys)):
+                    return False
+                pipe.multi()
+                for key in self.keys:
+                    pipe.pexpire(key, int(self.lease * 1000))
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        self.renewed_at = started_at
+        return True
+
+    def renew_until_released(self):
+        while not self.stop_renewal.wait(self.lease / 3):
+            if self.heartbeat:
+                self.heartbeat()
+            if self.lost:
+                continue
+            try:
+                renewed = self.renew()
+            except redis.RedisError as error:
+                logger.warning("Unable to renew lock %s: %s", self, error)
+                renewed = time.monotonic() - self.renewed_at < self.lease
+            if not renewed:
+                logger.error("Lock %s was lost - the lease expired before it was renewed", self)
+                self.lost = True
+
+    def check(self):
+        """Renew the lease, and raise LockLost if any of the keys may have been held by another process since the previous renewal"""
+        if self.lost or time.monotonic() - self.renewed_at >= self.lease or not self.renew():
+            self.lost = True
+            raise LockLost(f"Lock {self} was lost")
+
+    def release(self):
+        """Stop renewing the lease, and delete keys still held by this lock"""
+        if not self.acquired:
+            return
+        self.stop_renewal.set()
+        if self.renewal_thread:
+            self.renewal_thread.join()
+        self.acquired = False
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(*self.keys)
+                held_keys = [key for key, value in zip(self.keys, pipe.mget(self.keys)) if value is not None and value.decode() == self.token]
+                pipe.multi()
+                if held_keys:
+                    pipe.delete(*held_keys)
+                pipe.execute()
+            except redis.WatchError:
+                logger.warning("Lock %s changed while releasing it - keys were not deleted, and will expire in %s seconds", self, self.lease)
+
+
+def is_locked(key, redis_instance=None):
+    return bool((redis_instance or redis_client).exists(key))
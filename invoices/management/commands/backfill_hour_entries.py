@@ -0,0 +1,52 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoices.syncing.backfill import run_backfill
+
+
+class Command(BaseCommand):
+    help = "Backfill hour entries for a long date range. Interrupted backfills continue from the first unfinished chunk when run again with the same arguments."
+
+    DATE_FORMAT = "%Y-%m-%d"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start-date",
+            dest="start_date",
+            required=True,
+            help="Start date for the backfill",
+        )
+        parser.add_argument(
+            "--end-date",
+            dest="end_date",
+            required=True,
+            help="End date for the backfill",
+        )
+        parser.add_argument(
+            "--chunk-days",
+            dest="chunk_days",
+            type=int,
+            default=30,
+            help="Length of a single chunk in days",
+        )
+        parser.add_argument(
+            "--workers",
+            dest="workers",
+            type=int,
+            default=4,
+            help="Number of chunks fetched from 10000ft in parallel",
+        )
+
+    def handle(self, *args, **options):
+        start_date = datetime.datetime.strptime(options["start_date"], self.DATE_FORMAT).date()
+        end_date = datetime.datetime.strptime(options["end_date"], self.DATE_FORMAT).date()
+        if end_date < start_date:
+            raise CommandError("End date must not be before start date.")
+        if options["chunk_days"] < 1 or options["workers"] < 1:
+            raise CommandError("--chunk-days and --workers must be positive.")
+
+        written_entries, failed_chunks = run_backfill(start_date, end_date, chunk_days=options["chunk_days"], workers=options["workers"])
+        if failed_chunks:
+            raise CommandError(f"{failed_chunks} chunks failed. Run the same command again to retry these.")
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {start_date} - {end_date}: added or deleted {written_entries} entries"))
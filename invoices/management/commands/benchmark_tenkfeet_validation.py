@@ -0,0 +1,103 @@
+import datetime
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoices.tenkfeet_api import TenkFeetApi
+
+
+def generate_time_entries(count):
+    """Generate time entries that look like /api/v1/time_entries?fields=approvals responses"""
+    entries = []
+    start_date = datetime.date(2018, 1, 1)
+    for i in range(count):
+        date = start_date + datetime.timedelta(days=i % 365)
+        timestamp = f"{date:%Y-%m-%d}T12:{i % 60:02d}:00Z"
+        approvals = []
+        if i % 3:
+            approvals.append({
+                "id": i,
+                "status": "approved" if i % 3 == 1 else "pending",
+                "approvable_id": i,
+                "approvable_type": "TimeEntry",
+                "submitted_by": i % 100,
+                "submitted_at": timestamp,
+                "approved_by": i % 100 if i % 3 == 1 else None,
+                "approved_at": timestamp if i % 3 == 1 else None,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+            })
+        entries.append({
+            "id": i,
+            "assignable_id": i % 500,
+            "assignable_type": "Project",
+            "user_id": i % 100,
+            "bill_rate": 95.0 if i % 2 else "95.0",
+            "bill_rate_id": i % 10 if i % 4 else None,
+            "date": f"{date:%Y-%m-%d}",
+            "hours": 7.5,
+            "scheduled_hours": None if i % 5 else 7.5,
+            "notes": "Implementation" if i % 2 else None,
+            "task": None,
+            "is_suggestion": False,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "approvals": {
+                "data": approvals,
+                "paging": {"next": None, "page": 1, "per_page": 1000, "previous": None, "self": f"/api/v1/time_entries/{i}/approvals"},
+            },
+        })
+    return entries
+
+
+class Command(BaseCommand):
+    help = "Compare 10000ft time entry validation speed with schema.Schema and the compiled validator"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            dest="file",
+            help="JSON file with a recorded list of time entries (the \"data\" of /api/v1/time_entries pages)",
+        )
+        parser.add_argument(
+            "--entries",
+            dest="entries",
+            type=int,
+            default=100000,
+            help="Number of generated time entries, if --file is not given",
+        )
+        parser.add_argument(
+            "--page-size",
+            dest="page_size",
+            type=int,
+            default=10000,
+            help="Validate entries in pages of this size, as fetch_endpoint does",
+        )
+
+    def handle(self, *args, **options):
+        if options["file"]:
+            with open(options["file"]) as recorded_file:
+                entries = json.load(recorded_file)
+            if isinstance(entries, dict):
+                entries = entries["data"]
+        else:
+            entries = generate_time_entries(options["entries"])
+        page_size = options["page_size"]
+        pages = [entries[i:i + page_size] for i in range(0, len(entries), page_size)]
+        self.stdout.write(f"Validating {len(entries)} time entries in {len(pages)} pages")
+
+        schema = TenkFeetApi.TIME_ENTRIES_SCHEMA
+        start_time = time.time()
+        schema_result = [entry for page in pages for entry in schema.schema.validate(page)]
+        schema_duration = time.time() - start_time
+
+        start_time = time.time()
+        compiled_result = [entry for page in pages for entry in schema.validate(page)]
+        compiled_duration = time.time() - start_time
+
+        if schema_result != compiled_result:
+            raise CommandError("Compiled validator returned different data than schema.Schema")
+        self.stdout.write(f"schema.Schema: {schema_duration:.2f}s")
+        self.stdout.write(f"Compiled validator: {compiled_duration:.2f}s")
+        self.stdout.write(self.style.SUCCESS(f"Results are identical. Compiled validator is {schema_duration / max(compiled_duration, 0.001):.1f}x faster."))
@@ -3,7 +3,7 @@ import datetime
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
-from invoices.models import DataUpdate, Event
+from invoices.models import DataUpdate, Event, QueuedJob, SlackNotification
 
 
 class Command(BaseCommand):
@@ -34,5 +34,11 @@ class Command(BaseCommand):
         elif cleanup_type == "dataupdate":
             delete_count, _ = DataUpdate.objects.filter(created_at__lt=remove_entries_older_than).delete()
             self.stdout.write(self.style.SUCCESS(f"Cleaned up dataupdates older than {remove_older} days - count: {delete_count}"))
+        elif cleanup_type == "queuedjob":
+            delete_count, _ = QueuedJob.objects.filter(status__in=("done", "failed"), created_at__lt=remove_entries_older_than).delete()
+            self.stdout.write(self.style.SUCCESS(f"Cleaned up finished queued jobs older than {remove_older} days - count: {delete_count}"))
+        elif cleanup_type == "slacknotification":
+            delete_count, _ = SlackNotification.objects.filter(status__in=("sent", "failed", "unknown"), created_at__lt=remove_entries_older_than).delete()
+            self.stdout.write(self.style.SUCCESS(f"Cleaned up finished Slack notifications older than {remove_older} days - count: {delete_count}"))
         else:
             raise CommandError("Invalid type")
@@ -1,9 +1,9 @@
 """
-Listen to `request-refresh` redis pubsub, and process 10000ft hour entry updates, and send Slack notifications.
+Process jobs from the durable job queue (see invoices.job_queue): 10000ft hour entry updates, Slack notifications and unfurling links posted to Slack.
 
-Multiple simultaneous requests are queued, but executed one by one.
+Each worker executes jobs one by one, and acknowledges them after processing. The worker waits for `request-refresh` redis messages between jobs, and polls the queue every JOB_POLL_INTERVAL seconds in case a message was lost.
 
-Never run more than one instance of this command - pubsub will deliver requests to each instance, and you will have some surprising behaviour out of the system.
+Multiple instances of this command can be run at the same time. Jobs writing to the same hour entry dates, or sending the same type of notifications, are not run concurrently while their locks are held (see invoices.job_queue). Jobs left running by an interrupted worker are queued again by any worker after their lock and heartbeat have expired.
 """
 import datetime
 import json
@@ -14,24 +14,17 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from flex_hours.utils import send_flex_saldo_notifications
+from flex_hours.utils import refresh_flex_saldo_snapshots, send_flex_saldo_notifications
+from invoices.job_queue import JOB_QUEUE_CHANNEL, ack_job, claim_next_job, requeue_interrupted_jobs, requeue_job
+from invoices.locking import LockLost
 from invoices.models import DataUpdate, SlackNotificationBundle
 from invoices.slack import send_unapproved_hours_notifications, send_unsubmitted_hours_notifications
 from invoices.syncing.tenkfeet import HourEntryUpdate, refresh_invoice_stats
+from slack_hooks.utils import process_flex_saldo_command_response, process_unfurl_event
 
 
-def update_10kf_data(logger, data, redis_instance):
-    now = timezone.now()
-    if not data.get("force", False):
-        try:
-            latest_run = DataUpdate.objects.exclude(finished_at=None).latest("finished_at")
-            if now - latest_run.finished_at < datetime.timedelta(seconds=10):
-                logger.info("Last hour entry update finished recently. Skipping this data update.")
-                latest_run.aborted = True
-                latest_run.save()
-                return
-        except DataUpdate.DoesNotExist:
-            pass
+def update_10kf_data(logger, data, redis_instance, lock):
+    # Recently finished updates are not checked here: overlapping requests are merged in the queue, and with multiple workers the latest finished update may have covered a different date range.
     update_obj = DataUpdate.objects.filter(started_at=None).filter(aborted=False)
     obj_count = update_obj.count()
     if obj_count > 1:
@@ -39,7 +32,7 @@ def update_10kf_data(logger, data, redis_instance):
         update_obj = update_obj[obj_count - 1]
     else:
         update_obj = DataUpdate()
-    DataUpdate.objects.filter(aborted=False).filter(finished_at=None).update(aborted=True)
+    DataUpdate.objects.filter(aborted=False).filter(started_at=None).update(aborted=True)
     update_obj.aborted = False
     update_obj.started_at = timezone.now()
     update_obj.save()
@@ -47,13 +40,15 @@ def update_10kf_data(logger, data, redis_instance):
     end_date = datetime.datetime.strptime(data["end_date"], "%Y-%m-%d").date()
     logger.info("Updating hour entries.")
     update_obj.started_at = timezone.now()
-    hour_entry_update = HourEntryUpdate(start_date, end_date)
-    _, _, updated_entries_count = hour_entry_update.update()
+    hour_entry_update = HourEntryUpdate(start_date, end_date, force=data.get("force", False))
+    _, _, updated_entries_count = hour_entry_update.update(lock=lock)
     logger.info("Hour entry update done.")
     if updated_entries_count > 0:
         logger.info("Update invoice statistics.")
         refresh_invoice_stats(start_date, end_date)
         logger.info("Invoice statistics updated.")
+        refresh_flex_saldo_snapshots()
+        logger.info("Flex saldos updated.")
     else:
         logger.info("No entries were updated - skipped updating invoice statistics")
     update_obj.finished_at = timezone.now()
@@ -103,25 +98,59 @@ def slack_unsubmitted_notifications(logger, data):
     send_unsubmitted_hours_notifications(start_date, end_date)
 
 
+def process_job(logger, data, redis_instance, lock):
+    if data["type"] == "data-update":
+        update_10kf_data(logger, data, redis_instance, lock)
+    elif data["type"] == "slack-unsubmitted-notification":
+        slack_unsubmitted_notifications(logger, data)
+    elif data["type"] == "slack-unapproved-notification":
+        slack_unapproved_notifications(logger, data)
+    elif data["type"] == "slack-flex-saldo-notification":
+        slack_flex_saldo_notifications(logger)
+    elif data["type"] == "slack-unfurl":
+        process_unfurl_event(data["event"])
+    elif data["type"] == "slack-flex-saldo-response":
+        process_flex_saldo_command_response(data["user_guid"], data["response_url"])
+    else:
+        raise ValueError(f"Unhandled job type: {data['type']}")
+
+
 class Command(BaseCommand):
-    help = "Run background worker to import hour entries from 10000ft, and to send slack notifications. NEVER RUN MORE THAN ONE INSTANCE OF THIS COMMAND SIMULTANEOUSLY."
+    help = "Run background worker to import hour entries from 10000ft, and to send slack notifications. Multiple workers can be run simultaneously."
+
+    JOB_POLL_INTERVAL = 30  # seconds
 
     def handle(self, *args, **options):
         logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
         redis_instance = redis.from_url(settings.REDIS)
         pubsub = redis_instance.pubsub(ignore_subscribe_messages=True)
-        pubsub.subscribe("request-refresh")
-        for entry in pubsub.listen():
-            logger.info("Received %s from redis queue", entry)
-            data = json.loads(entry["data"])
-            if data["type"] == "data-update":
-                update_10kf_data(logger, data, redis_instance)
-            elif data["type"] == "slack-unsubmitted-notification":
-                slack_unsubmitted_notifications(logger, data)
-            elif data["type"] == "slack-unapproved-notification":
-                slack_unapproved_notifications(logger, data)
-            elif data["type"] == "slack-flex-saldo-notification":
-                slack_flex_saldo_notifications(logger)
+        pubsub.subscribe(JOB_QUEUE_CHANNEL)
+        while True:
+            claimed_job = claim_next_job()
+            if not claimed_job:
+                requeued_jobs = requeue_interrupted_jobs()
+                if requeued_jobs:
+                    logger.warning("Queued %s interrupted jobs again", requeued_jobs)
+                    continue
+                # Returns after a single message, or after the timeout. Messages only wake up the worker; jobs are read from the database.
+                pubsub.get_message(timeout=self.JOB_POLL_INTERVAL)
+                continue
+            job, lock = claimed_job
+            logger.info("Processing %s (merged %s requests): %s", job, job.merged_jobs, job.data)
+            try:
+                process_job(logger, json.loads(job.data), redis_instance, lock)
+            except LockLost:
+                logger.warning("Lock for %s was lost before committing - queued it again", job)
+                requeue_job(job)
+            except Exception as error:  # pylint:disable=broad-except
+                logger.exception("Processing %s failed", job)
+                ack_job(job, error=str(error))
             else:
-                logger.error("Unhandled data: %s", entry)
+                ack_job(job)
+            finally:
+                if lock.lost:
+                    logger.error("Lock for %s was lost while processing it", job)
+                lock.release()
+            # Jobs waiting for the released lock can be processed by other workers now.
+            redis_instance.publish(JOB_QUEUE_CHANNEL, job.id)
@@ -1,10 +1,9 @@
 import datetime
-import json
 
-import redis
-from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
+from invoices.job_queue import queue_job
+
 
 class Command(BaseCommand):
     help = "Queue new data refresh"
@@ -18,13 +17,13 @@ class Command(BaseCommand):
             "--force",
             action="store_true",
             dest="force",
-            help="Force update, instead of skipping if update was recently executed",
+            help="Ignore stored hour entry checksums, and replace entries for all dates in the range",
         )
         parser.add_argument(
             "--automatic-split",
             action="store_true",
             dest="automatic_split",
-            help="Automatically split long date ranges to shorter update requests. For consistent results, consider using --force with this.",
+            help="Automatically split long date ranges to shorter update requests",
         )
         parser.add_argument(
             "--start-date",
@@ -70,5 +69,4 @@ class Command(BaseCommand):
             "end_date": end_date.strftime(self.DATE_FORMAT),
         }
         self.stdout.write(self.style.SUCCESS(f"Queued update for {start_date} - {end_date}"))
-        redis_instance = redis.from_url(settings.REDIS)
-        redis_instance.publish("request-refresh", json.dumps(data))
+        queue_job(data)
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from invoices.syncing.slack import sync_slack_channels, sync_slack_users
-from invoices.syncing.tenkfeet import sync_10000ft_projects, sync_10000ft_users
+from invoices.syncing.tenkfeet import sync_10000ft_all, sync_10000ft_projects, sync_10000ft_users
 
 
 class Command(BaseCommand):
@@ -11,6 +11,7 @@ class Command(BaseCommand):
         "10000ft": {
             "users": sync_10000ft_users,
             "projects": sync_10000ft_projects,
+            "all": sync_10000ft_all,
         },
         "slack": {
             "users": sync_slack_users,
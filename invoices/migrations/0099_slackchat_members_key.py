@@ -0,0 +1,36 @@
+# Generated by Django 2.0 on 2018-02-13 14:37
+
+from django.db import migrations, models
+
+
+def set_members_key(apps, schema_editor):
+    SlackChat = apps.get_model('invoices', 'SlackChat')
+    seen_keys = set()
+    for slack_chat in SlackChat.objects.all().prefetch_related('slackchatmember_set').order_by('chat_id'):
+        members_key = ','.join(sorted(set(member.member_id for member in slack_chat.slackchatmember_set.all())))
+        if not members_key or members_key in seen_keys:
+            continue
+        seen_keys.add(members_key)
+        slack_chat.members_key = members_key
+        slack_chat.save(update_fields=['members_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0098_slacknotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slackchat',
+            name='members_key',
+            field=models.CharField(blank=True, editable=False, max_length=500, null=True),
+        ),
+        migrations.RunPython(set_members_key, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='slackchat',
+            name='members_key',
+            field=models.CharField(blank=True, editable=False, max_length=500, null=True, unique=True),
+        ),
+    ]
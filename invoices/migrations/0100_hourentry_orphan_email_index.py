@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2018-02-14 10:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Index lower-cased email of hour entries without a linked user, for linking entries to users (see link_orphan_hour_entries)"""
+
+    dependencies = [
+        ('invoices', '0099_slackchat_members_key'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX invoices_hourentry_orphan_email_idx ON invoices_hourentry (LOWER(user_email)) WHERE user_m_id IS NULL',
+            'DROP INDEX invoices_hourentry_orphan_email_idx',
+        ),
+    ]
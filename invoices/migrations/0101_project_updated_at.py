@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2018-02-14 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0100_hourentry_orphan_email_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
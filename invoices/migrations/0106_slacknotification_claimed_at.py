@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2018-02-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0105_slacknotification_unknown_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slacknotification',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
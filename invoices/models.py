@@ -287,6 +287,7 @@ class Project(models.Model):
     amazon_account = models.ManyToManyField("AmazonLinkedAccount", blank=True)
     admin_users = models.ManyToManyField("TenkfUser", blank=True)
     thumbnail_url = models.CharField(max_length=1024, null=True, blank=True)
+    updated_at = models.DateTimeField(null=True, blank=True)
 
     @property
     def full_name(self):
@@ -435,14 +436,113 @@ class SlackNotificationBundle(models.Model):  # TODO: migrate to Event
         ordering = ("-sent_at", "notification_type")
 
 
+class SlackNotification(models.Model):
+    """Outbox for rendered Slack messages
+
+    Notification builders store messages here in bulk, and invoices.slack_delivery.send_slack_notifications delivers pending messages in batches. idempotency_key identifies a single message in a single notification bundle, so re-running a bundle only sends messages that were not sent earlier.
+    """
+
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("sending", "Sending"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+        ("unknown", "Unknown"),  # May have been posted - not sent again automatically
+    )
+
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    notification_type = models.CharField(max_length=50)
+    channel = models.CharField(max_length=50)
+    text = models.TextField(null=True, blank=True)
+    attachments = models.TextField(null=True, blank=True)  # JSON encoded list of attachments
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending", db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # When the message was moved to "sending" state
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.idempotency_key} - {self.status}"
+
+    class Meta:
+        ordering = ("-created_at",)
+
+
 class HourEntryChecksum(models.Model):
     date = models.DateField(primary_key=True)
     sha256 = models.CharField(max_length=64)
 
 
+class QueuedJob(models.Model):
+    """Durable queue for background jobs processed by process_update_queue
+
+    See invoices.job_queue. Queued data updates with overlapping or adjacent date ranges are merged into a single job, and identical queued jobs of other types are deduplicated.
+    """
+
+    STATUS_CHOICES = (
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+
+    job_type = models.CharField(max_length=50)
+    data = models.TextField()  # JSON encoded job, including "type"
+    start_date = models.DateField(null=True, blank=True)
+    end_date = models.DateField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="queued", db_index=True)
+    merged_jobs = models.IntegerField(default=0)  # Number of requests merged to this job
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Updated by the worker while the job is running
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.job_type} - {self.start_date} - {self.end_date} - {self.status}"
+
+    class Meta:
+        ordering = ("-created_at",)
+
+
+class BackfillChunk(models.Model):
+    """Progress of a single chunk of a historical hour entry backfill
+
+    invoices.syncing.backfill.run_backfill splits a long date range into chunks, and stores their state here. Running the same backfill again skips chunks that are already done.
+    """
+
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+
+    backfill = models.CharField(max_length=50)  # Identifies the backfill: "<start date>:<end date>:<chunk length in days>"
+    start_date = models.DateField()
+    end_date = models.DateField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    entries_count = models.IntegerField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.backfill} - {self.start_date} - {self.end_date} - {self.status}"
+
+    class Meta:
+        unique_together = ("backfill", "start_date")
+        ordering = ("backfill", "start_date")
+
+
 @reversion.register()
 class SlackChat(models.Model):
     chat_id = models.CharField(max_length=50, primary_key=True, editable=False)
+    members_key = models.CharField(max_length=500, unique=True, null=True, blank=True, editable=False)  # Sorted, comma separated list of member IDs
+
+    @staticmethod
+    def get_members_key(members):
+        return ",".join(sorted(set(members)))
 
 
 @reversion.register()
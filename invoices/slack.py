@@ -1,59 +1,72 @@
 import datetime
-import json
+import itertools
 import logging
 
-import redis
 import slacker
 from django.conf import settings
 from django.db.models import Count, Sum
 from django.urls import reverse
 
-from invoices.models import Event, Project, SlackChannel, SlackChat, SlackChatMember, SlackNotificationBundle, TenkfUser
+from invoices.job_queue import queue_job
+from invoices.models import Event, HourEntry, Project, SlackChannel, SlackChat, SlackChatMember, SlackNotificationBundle
+from invoices.slack_delivery import SlackOutbox, send_slack_notifications
 
 slack = slacker.Slacker(settings.SLACK_BOT_ACCESS_TOKEN)  # pylint:disable=invalid-name
 logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
-redis_client = redis.from_url(settings.REDIS)  # pylint:disable=invalid-name
 
 
 def queue_slack_notification(notification_type):
     if notification_type not in ("unapproved", "unsubmitted"):
         raise ValueError("Invalid notification type")
-    redis_client.publish("request-refresh", json.dumps({"type": f"slack-{notification_type}-notification"}))
+    queue_job({"type": f"slack-{notification_type}-notification"})
 
 
-def create_slack_mpim(members_list):
-    slack_chat = SlackChat.objects.annotate(users_count=Count("slackchatmember")).filter(users_count=len(members_list))
-    for recipient in members_list:
-        slack_chat = slack_chat.filter(slackchatmember__member_id=recipient)
+def create_slack_mpim(members_list, slack_chats=None):
+    """Return ID of a group chat with members_list, creating a new chat if needed
 
-    if slack_chat.count() == 0:
+    slack_chats is an optional {members_key: chat_id} mapping, which is shared between calls to avoid repeated lookups.
+    """
+    members_key = SlackChat.get_members_key(members_list)
+    if slack_chats is not None and members_key in slack_chats:
+        return slack_chats[members_key]
+    chat_id = SlackChat.objects.filter(members_key=members_key).values_list("chat_id", flat=True).first()
+
+    if not chat_id:
         if len(members_list) < 2:
             logger.info("Unable to create a new chat for %s - not enough members", members_list)
             return None
         logger.info("Trying to create a new Slack group chat with %s.", members_list)
         slack_chat_details = slack.mpim.open(",".join(members_list))
         chat_id = slack_chat_details.body["group"]["id"]
-        slack_chat = SlackChat(chat_id=chat_id)
-        slack_chat.save()
-        for member in members_list:
-            SlackChatMember(slack_chat=slack_chat, member_id=member).save()
+        slack_chat, _ = SlackChat.objects.update_or_create(chat_id=chat_id, defaults={"members_key": members_key})
+        SlackChatMember.objects.filter(slack_chat=slack_chat).delete()
+        SlackChatMember.objects.bulk_create([SlackChatMember(slack_chat=slack_chat, member_id=member) for member in set(members_list)])
         logger.info("Created a new slack.mpim for %s.", members_list)
-    else:
-        slack_chat = slack_chat[0]
-        chat_id = slack_chat.chat_id
+    if slack_chats is not None:
+        slack_chats[members_key] = chat_id
     return chat_id
 
 
 def send_unsubmitted_hours_notifications(first_day, last_day):
     today = datetime.date.today()
     notification_count = 0
-    for user in TenkfUser.objects.filter(hourentry__status="Unsubmitted", hourentry__date__lte=last_day, hourentry__date__gte=first_day).annotate(entries_count=Count("hourentry__user_m")).annotate(sum_of_hours=Sum("hourentry__incurred_hours")):
-        fallback_message = """<https://{}{}|You> have *unsubmitted hours*: {} hour markings with total of {} hours. Go to <https://app.10000ft.com|10000ft> to submit these hours.""".format(settings.DOMAIN, reverse("person_month", args=(str(user.guid), today.year, today.month)), user.entries_count, user.sum_of_hours)
+    outbox = SlackOutbox("unsubmitted", f"{first_day}-{last_day}")
+    unsubmitted_hours = HourEntry.objects.filter(status="Unsubmitted", date__lte=last_day, date__gte=first_day).exclude(user_m=None).select_related("user_m", "invoice__project_m__client_m").order_by("user_m", "date")
+    submit_url = "https://{}{}".format(settings.DOMAIN, reverse("your_unsubmitted_hours"))
+    project_urls = {}
+    for user, user_hours in itertools.groupby(unsubmitted_hours, key=lambda entry: entry.user_m):
+        user_hours = list(user_hours)
+        entries_count = len(user_hours)
+        sum_of_hours = sum(entry.incurred_hours for entry in user_hours)
+        fallback_message = """<https://{}{}|You> have *unsubmitted hours*: {} hour markings with total of {} hours. Go to <https://app.10000ft.com|10000ft> to submit these hours.""".format(settings.DOMAIN, reverse("person_month", args=(str(user.guid), today.year, today.month)), entries_count, sum_of_hours)
         message = "You need to submit or remove following hours:"
-        unsubmitted_hours = user.hourentry_set.filter(status="Unsubmitted").filter(date__lte=last_day, date__gte=first_day).exclude(invoice__project_m__archived=True).select_related("invoice", "invoice__project_m").order_by("date")  # TODO: select_related
-        for unsubmitted_hour in unsubmitted_hours:
-            url = "https://{}{}".format(settings.DOMAIN, reverse("project", args=(unsubmitted_hour.invoice.project_m.guid,)))
-            project_name_field = f"<{url}|{unsubmitted_hour.invoice.project_m.client_m.name} - {unsubmitted_hour.invoice.project_m.name}>"
+        for unsubmitted_hour in user_hours:
+            project = unsubmitted_hour.invoice.project_m
+            if project.archived:
+                continue
+            if project.guid not in project_urls:
+                project_urls[project.guid] = "https://{}{}".format(settings.DOMAIN, reverse("project", args=(project.guid,)))
+            project_name_field = f"<{project_urls[project.guid]}|{project.client_m.name} - {project.name}>"
             message += "\n- {} - {} - {} - {} - {}h - {}".format(unsubmitted_hour.date, project_name_field, unsubmitted_hour.category, unsubmitted_hour.phase_name, unsubmitted_hour.incurred_hours, unsubmitted_hour.notes)
 
         attachment = {
@@ -64,14 +77,14 @@ def send_unsubmitted_hours_notifications(first_day, last_day):
             "title_link": "https://app.10000ft.com",
             "text": message,
             "fields": [
-                {"title": "Unsubmitted markings", "value": f"{user.entries_count}", "short": True},
-                {"title": "Unsubmitted hours", "value": f"{user.sum_of_hours:.2f}h", "short": True},
+                {"title": "Unsubmitted markings", "value": f"{entries_count}", "short": True},
+                {"title": "Unsubmitted hours", "value": f"{sum_of_hours:.2f}h", "short": True},
             ],
             "actions": [
                 {
                     "type": "button",
                     "text": "Submit your hours",
-                    "url": "https://{}{}".format(settings.DOMAIN, reverse("your_unsubmitted_hours")),
+                    "url": submit_url,
                     "style": "primary",
                 },
                 {
@@ -86,21 +99,25 @@ def send_unsubmitted_hours_notifications(first_day, last_day):
         if not user.slack_id:
             logger.warning("No slack_id for %s", user.email)
             for admin in settings.SLACK_NOTIFICATIONS_ADMIN:
-                slack.chat.post_message(admin, text=f"Unsubmitted hours by {user.email}, but no slack ID available.", attachments=[attachment], as_user="finance-bot")
+                outbox.post_message(admin, f"{user.guid}:admin", text=f"Unsubmitted hours by {user.email}, but no slack ID available.", attachments=[attachment])
             continue
 
-        slack.chat.post_message(user.slack_id, attachments=[attachment], as_user="finance-bot")
+        outbox.post_message(user.slack_id, user.guid, attachments=[attachment])
         notification_count += 1
 
         for admin in settings.SLACK_NOTIFICATIONS_ADMIN:
             if admin != user.slack_id:
-                slack.chat.post_message(admin, text=f"This was sent to {user.email} in slack:", attachments=[attachment], as_user="finance-bot")
+                outbox.post_message(admin, f"{user.guid}:admin", text=f"This was sent to {user.email} in slack:", attachments=[attachment])
+    outbox.enqueue()
+    sent_count, failed_count = send_slack_notifications("unsubmitted")
     SlackNotificationBundle(notification_type="unsubmitted").save()
-    Event(event_type="send_unsubmitted_hours_notifications", succeeded=True, message=f"Sent {notification_count} notifications").save()
+    Event(event_type="send_unsubmitted_hours_notifications", succeeded=failed_count == 0, message=f"Created {notification_count} notifications. Sent {sent_count} Slack messages, {failed_count} failed.").save()
 
 
 def send_unapproved_hours_notifications(first_day, last_day):
     notification_count = 0
+    outbox = SlackOutbox("unapproved", f"{first_day}-{last_day}")
+    slack_chats = dict(SlackChat.objects.exclude(members_key=None).values_list("members_key", "chat_id"))
     for project in Project.objects.filter(invoice__hourentry__approved=False, invoice__hourentry__date__lte=last_day, invoice__hourentry__date__gte=first_day).annotate(entries_count=Count("invoice__hourentry")).annotate(sum_of_hours=Sum("invoice__hourentry__incurred_hours")).annotate(sum_of_money=Sum("invoice__hourentry__incurred_money")).prefetch_related("admin_users").select_related("client_m"):
         message = f"""You are marked as a responsible person for {project.client_m.name} - {project.name}. You need to approve hours for the project weekly."""
         fallback_message = f"""You are marked as a responsible person for {project.client_m.name} - {project.name}. You need to approve hours for the project weekly. Go to https://app.10000ft.com to do so."""
@@ -134,29 +151,31 @@ def send_unapproved_hours_notifications(first_day, last_day):
 
         members_list = set([member.slack_id for member in project.admin_users.all() if member.slack_id])
         if len(members_list) > 1:
-            chat_id = create_slack_mpim(members_list)
+            chat_id = create_slack_mpim(members_list, slack_chats)
             if not chat_id:
                 logger.warning("No chat_id for %s - %s", project, members_list)
                 continue
             logger.info("%s %s", message, chat_id)
             notification_count += 1
-            slack.chat.post_message(chat_id, attachments=[attachment], as_user="finance-bot")
+            outbox.post_message(chat_id, project.guid, attachments=[attachment])
         elif members_list:
             # members_list is never empty
             notification_count += 1
-            slack.chat.post_message(list(members_list)[0], attachments=[attachment], as_user="finance-bot")
+            outbox.post_message(list(members_list)[0], project.guid, attachments=[attachment])
         else:
             logger.warning("Unapproved hours in %s, but no admin users specified.", project.name)
             for admin in settings.SLACK_NOTIFICATIONS_ADMIN:
-                slack.chat.post_message(admin, text=f"Unapproved hours in {project.name} (id: {project.project_id}), but no admin users specified.", attachments=[attachment], as_user="finance-bot")
+                outbox.post_message(admin, f"{project.guid}:admin", text=f"Unapproved hours in {project.name} (id: {project.project_id}), but no admin users specified.", attachments=[attachment])
             continue
 
         for admin in settings.SLACK_NOTIFICATIONS_ADMIN:
             if admin not in members_list:
-                slack.chat.post_message(admin, text="This was sent to {} in slack:".format(", ".join(project.admin_users.all().values_list("display_name", flat=True))), attachments=[attachment], as_user="finance-bot")
+                outbox.post_message(admin, f"{project.guid}:admin", text="This was sent to {} in slack:".format(", ".join(project.admin_users.all().values_list("display_name", flat=True))), attachments=[attachment])
 
+    outbox.enqueue()
+    sent_count, failed_count = send_slack_notifications("unapproved")
     SlackNotificationBundle(notification_type="unapproved").save()
-    Event(event_type="send_unapproved_hours_notifications", succeeded=True, message=f"Sent {notification_count} notifications").save()
+    Event(event_type="send_unapproved_hours_notifications", succeeded=failed_count == 0, message=f"Created {notification_count} notifications. Sent {sent_count} Slack messages, {failed_count} failed.").save()
 
 
 def send_new_project_to_slack(project):
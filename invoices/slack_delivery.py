@@ -0,0 +1,254 @@
+"""
+Concurrent, rate-limited delivery of Slack messages.
+
+Notification builders queue messages with SlackDelivery.post_message, and SlackDelivery.deliver sends the whole batch with a small pool of threads. Calls are throttled per API method and per channel, and the outcome is recorded on each SlackMessage. Only calls that were clearly not processed by Slack are retried with exponential backoff (honouring Slack's Retry-After): connection failures before the request was sent, and rate limited calls. Slack may have posted the message despite a read timeout or a server error, so these are recorded as "unknown" instead of retrying them and possibly posting the same message twice.
+
+Notification builders do not send messages directly: they collect rendered messages with SlackOutbox and store them to the SlackNotification table in bulk. send_slack_notifications drains pending messages in batches, so a crash in the middle of a bundle does not require re-rendering it, and re-running a bundle only sends what is still pending.
+
+The API address is configurable with SLACK_API_URL, so this can be run against a local fake Slack server.
+"""
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from urllib3.exceptions import NewConnectionError
+
+from invoices.models import SlackNotification
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+
+class RateLimiter(object):
+    """Thread-safe limiter allowing at most `rate` calls per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def is_unsent_error(error):
+    """Return True if a requests exception was raised before the request was sent"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # Refused connections and failed DNS lookups. Other connection errors may happen after the request was sent.
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+class SlackMessage(object):
+    def __init__(self, channel, text=None, attachments=None, as_user="finance-bot"):
+        self.channel = channel
+        self.text = text
+        self.attachments = attachments
+        self.as_user = as_user
+        self.status = "pending"  # pending, sent, failed (not posted) or unknown (may have been posted)
+        self.attempts = 0
+        self.error = None
+        self.ts = None
+
+    def __str__(self):
+        return f"{self.channel} - {self.status}"
+
+
+class SlackDelivery(object):
+    # Calls per second for each API method. See https://api.slack.com/docs/rate-limits
+    METHOD_RATE_LIMITS = {
+        "chat.postMessage": 20,
+    }
+    CHANNEL_RATE_LIMIT = 1  # Slack allows roughly one message per second per channel.
+    RETRYABLE_ERRORS = ("ratelimited",)
+
+    def __init__(self, token=None, api_url=None, workers=None, max_retries=5, backoff=1.0, timeout=10):
+        self.token = token or settings.SLACK_BOT_ACCESS_TOKEN
+        self.api_url = api_url or settings.SLACK_API_URL
+        self.workers = workers or settings.SLACK_DELIVERY_WORKERS
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.messages = []
+        self.method_limiters = {method: RateLimiter(rate) for method, rate in self.METHOD_RATE_LIMITS.items()}
+        self.channel_limiters = {}
+        self.channel_limiters_lock = threading.Lock()
+        self.local = threading.local()
+
+    def post_message(self, channel, text=None, attachments=None, as_user="finance-bot"):
+        message = SlackMessage(channel, text, attachments, as_user)
+        self.messages.append(message)
+        return message
+
+    def deliver(self):
+        """Send all queued messages, and return them with their outcomes"""
+        messages, self.messages = self.messages, []
+        if not messages:
+            return messages
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.send, messages))
+        failed = [message for message in messages if message.status != "sent"]
+        for message in failed:
+            logger.warning("Unable to deliver a Slack message to %s after %s attempts (%s): %s", message.channel, message.attempts, message.status, message.error)
+        logger.info("Delivered %s Slack messages, %s failed", len(messages) - len(failed), len(failed))
+        return messages
+
+    def get_session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def get_channel_limiter(self, channel):
+        with self.channel_limiters_lock:
+            if channel not in self.channel_limiters:
+                self.channel_limiters[channel] = RateLimiter(self.CHANNEL_RATE_LIMIT)
+            return self.channel_limiters[channel]
+
+    def call(self, method, data):
+        """Call a Slack API method, and return (retry_after, response body)
+
+        retry_after is the number of seconds to wait before retrying calls that were not processed by Slack, and None for final responses. Final responses without "ok" have "unknown": True if Slack may have processed the call anyway.
+        """
+        if method in self.method_limiters:
+            self.method_limiters[method].wait()
+        try:
+            response = self.get_session().post(self.api_url + method, data=dict(data, token=self.token), timeout=self.timeout)
+        except requests.RequestException as error:
+            if is_unsent_error(error):
+                return 0, {"ok": False, "error": str(error)}
+            return None, {"ok": False, "error": str(error), "unknown": True}
+        if response.status_code == 429:
+            return float(response.headers.get("Retry-After", 1)), {"ok": False, "error": "ratelimited"}
+        if response.status_code >= 500:
+            return None, {"ok": False, "error": f"HTTP {response.status_code}", "unknown": True}
+        try:
+            body = response.json()
+        except ValueError:
+            return None, {"ok": False, "error": f"Invalid response: HTTP {response.status_code}", "unknown": True}
+        if not body.get("ok") and body.get("error") in self.RETRYABLE_ERRORS:
+            return float(response.headers.get("Retry-After", 0)), body
+        return None, body
+
+    def send(self, message):
+        data = {"channel": message.channel, "as_user": message.as_user}
+        if message.text:
+            data["text"] = message.text
+        if message.attachments:
+            data["attachments"] = json.dumps(message.attachments)
+        channel_limiter = self.get_channel_limiter(message.channel)
+        while message.attempts < self.max_retries:
+            message.attempts += 1
+            channel_limiter.wait()
+            retry_after, body = self.call("chat.postMessage", data)
+            if body.get("ok"):
+                message.status = "sent"
+                message.ts = body.get("ts")
+                message.error = None
+                return message
+            message.error = body.get("error")
+            if body.get("unknown"):
+                message.status = "unknown"
+                return message
+            if retry_after is None or message.attempts >= self.max_retries:
+                break
+            time.sleep(max(retry_after, self.backoff * 2 ** (message.attempts - 1) * random.uniform(0.5, 1.5)))
+        message.status = "failed"
+        return message
+
+
+class SlackOutbox(object):
+    """Collects rendered messages of a single notification bundle, and stores them to the outbox in bulk
+
+    bundle_key identifies the bundle (for example, the date range it covers). Together with the channel and the subject passed to post_message, it forms the idempotency key of each message.
+    """
+
+    def __init__(self, notification_type, bundle_key):
+        self.notification_type = notification_type
+        self.bundle_key = bundle_key
+        self.notifications = {}
+
+    def post_message(self, channel, subject, text=None, attachments=None):
+        idempotency_key = f"{self.notification_type}:{self.bundle_key}:{subject}:{channel}"
+        self.notifications[idempotency_key] = SlackNotification(idempotency_key=idempotency_key, notification_type=self.notification_type, channel=channel, text=text, attachments=json.dumps(attachments) if attachments else None)
+
+    def enqueue(self):
+        """Store all messages that are not already in the outbox, and return the number of new messages
+
+        Messages from earlier runs of the same bundle that failed are moved back to pending state.
+        """
+        existing_keys = set()
+        keys = list(self.notifications.keys())
+        for i in range(0, len(keys), 500):
+            existing_keys.update(SlackNotification.objects.filter(idempotency_key__in=keys[i:i + 500]).values_list("idempotency_key", flat=True))
+            SlackNotification.objects.filter(idempotency_key__in=keys[i:i + 500], status="failed").update(status="pending")
+        new_notifications = [notification for key, notification in self.notifications.items() if key not in existing_keys]
+        SlackNotification.objects.bulk_create(new_notifications, batch_size=500)
+        logger.info("Queued %s new Slack messages for %s %s (%s already queued)", len(new_notifications), self.notification_type, self.bundle_key, len(existing_keys))
+        self.notifications = {}
+        return len(new_notifications)
+
+
+SENDING_TIMEOUT = datetime.timedelta(hours=1)
+
+
+def expire_stale_sending_notifications():
+    """Move messages that have been in "sending" state for longer than SENDING_TIMEOUT to "unknown" state, and return the number of moved messages"""
+    stale = SlackNotification.objects.filter(status="sending").filter(Q(claimed_at__lt=timezone.now() - SENDING_TIMEOUT) | Q(claimed_at=None))
+    stale_count = stale.update(status="unknown", error="Delivery was interrupted - the message may have been posted")
+    if stale_count:
+        logger.warning("Moved %s Slack messages stuck in sending state to unknown state. These were not sent again, as they might have been already delivered.", stale_count)
+    return stale_count
+
+
+def send_slack_notifications(notification_type=None, batch_size=100, delivery=None):
+    """Send pending messages from the outbox in batches, and return (sent, failed) counts. Failed counts include messages with unknown outcome.
+
+    Each batch is claimed by moving it to "sending" state before any network calls are made. If the process crashes during delivery, the batch is left in "sending" state and is not automatically sent again, to avoid sending duplicate messages. Once SENDING_TIMEOUT has passed, these are moved to "unknown" state on the next run.
+    """
+    expire_stale_sending_notifications()
+    delivery = delivery or SlackDelivery()
+    sent_count = failed_count = 0
+    while True:
+        with transaction.atomic():
+            pending = SlackNotification.objects.filter(status="pending")
+            if notification_type:
+                pending = pending.filter(notification_type=notification_type)
+            batch = list(pending.select_for_update().order_by("id")[:batch_size])
+            if not batch:
+                break
+            SlackNotification.objects.filter(id__in=[notification.id for notification in batch]).update(status="sending", claimed_at=timezone.now())
+
+        messages = {}
+        for notification in batch:
+            attachments = json.loads(notification.attachments) if notification.attachments else None
+            messages[notification.id] = delivery.post_message(notification.channel, text=notification.text, attachments=attachments)
+        delivery.deliver()
+
+        sent_ids_by_attempts = defaultdict(list)
+        for notification_id, message in messages.items():
+            if message.status == "sent":
+                sent_ids_by_attempts[message.attempts].append(notification_id)
+                sent_count += 1
+            else:
+                # Messages with unknown outcome are not moved back to pending when the bundle is run again.
+                SlackNotification.objects.filter(id=notification_id).update(status=message.status, attempts=F("attempts") + message.attempts, error=message.error)
+                failed_count += 1
+        for attempts, sent_ids in sent_ids_by_attempts.items():
+            SlackNotification.objects.filter(id__in=sent_ids).update(status="sent", sent_at=timezone.now(), attempts=F("attempts") + attempts, error=None)
+    return sent_count, failed_count
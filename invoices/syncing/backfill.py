@@ -0,0 +1,107 @@
+"""
+Parallel, resumable backfill of historical hour entries.
+
+The date range is split into chunks. Up to `workers` chunks are fetched from 10000ft and merged in parallel threads (HourEntryUpdate.prepare), but prepared chunks are written to the database one at a time from the calling thread (HourEntryUpdate.write), so writes never overlap. Each chunk holds the same per-day locks as data update jobs (see invoices.job_queue) from before it is prepared until it has been written, so syncs run by process_update_queue workers do not write the same dates in between. If the lock is lost, writing the chunk fails, and it is retried on the next run.
+
+Each chunk is marked as done in BackfillChunk after it has been written. Running the same backfill again only processes chunks that are not done yet. Re-running a chunk is safe, as writing replaces all entries for the dates of the chunk.
+"""
+import itertools
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from flex_hours.utils import refresh_flex_saldo_snapshots
+from invoices.locking import DistributedLock, get_date_range_lock_keys
+from invoices.models import BackfillChunk, Event
+from invoices.syncing.tenkfeet import HourEntryUpdate, TenkfeetSyncSession, refresh_invoice_stats
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+
+def get_backfill_chunks(backfill, start_date, end_date, chunk_days):
+    """Return all chunks of a backfill, creating the ones that do not exist yet"""
+    existing_start_dates = set(BackfillChunk.objects.filter(backfill=backfill).values_list("start_date", flat=True))
+    new_chunks = []
+    chunk_start_date = start_date
+    while chunk_start_date <= end_date:
+        chunk_end_date = min(chunk_start_date + timedelta(days=chunk_days - 1), end_date)
+        if chunk_start_date not in existing_start_dates:
+            new_chunks.append(BackfillChunk(backfill=backfill, start_date=chunk_start_date, end_date=chunk_end_date))
+        chunk_start_date = chunk_end_date + timedelta(days=1)
+    BackfillChunk.objects.bulk_create(new_chunks)
+    return list(BackfillChunk.objects.filter(backfill=backfill).order_by("start_date"))
+
+
+def prepare_chunk(chunk, session):
+    """Lock the dates of a chunk, and prepare it. Returns (HourEntryUpdate, lock); the lock is released by write_chunk."""
+    lock = DistributedLock(get_date_range_lock_keys(chunk.start_date, chunk.end_date))
+    lock.wait()
+    try:
+        hour_entry_update = HourEntryUpdate(chunk.start_date, chunk.end_date, session=session)
+        hour_entry_update.prepare()
+        return hour_entry_update, lock
+    except Exception:
+        lock.release()
+        raise
+    finally:
+        connection.close()  # Each thread has its own database connection
+
+
+def write_chunk(hour_entry_update, lock):
+    try:
+        return hour_entry_update.write(lock=lock)
+    finally:
+        lock.release()
+
+
+def run_backfill(start_date, end_date, chunk_days=30, workers=4, session=None):
+    """Backfill hour entries between start_date and end_date, and return (written entries, failed chunks)"""
+    backfill = f"{start_date:%Y-%m-%d}:{end_date:%Y-%m-%d}:{chunk_days}"
+    chunks = get_backfill_chunks(backfill, start_date, end_date, chunk_days)
+    pending_chunks = [chunk for chunk in chunks if chunk.status != "done"]
+    logger.info("Backfill %s: %s chunks, %s already done", backfill, len(chunks), len(chunks) - len(pending_chunks))
+
+    session = session or TenkfeetSyncSession()
+    # Fetch collections shared by all chunks before starting threads, so each of these is fetched only once.
+    logger.info("Fetched %s phases and %s leave types", len(session.phases), len(session.leave_types))
+
+    written_entries = failed_chunks = 0
+    remaining_chunks = iter(pending_chunks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Only `workers` prepared chunks are kept in memory at a time.
+        futures = {executor.submit(prepare_chunk, chunk, session): chunk for chunk in itertools.islice(remaining_chunks, workers)}
+        while futures:
+            done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                chunk = futures.pop(future)
+                try:
+                    _, _, entries_count = write_chunk(*future.result())
+                except Exception as error:  # pylint:disable=broad-except
+                    logger.exception("Backfill %s: chunk %s - %s failed", backfill, chunk.start_date, chunk.end_date)
+                    chunk.status = "failed"
+                    chunk.error = str(error)
+                    failed_chunks += 1
+                else:
+                    logger.info("Backfill %s: chunk %s - %s done, %s entries", backfill, chunk.start_date, chunk.end_date, entries_count)
+                    chunk.status = "done"
+                    chunk.entries_count = entries_count
+                    chunk.error = None
+                    chunk.finished_at = timezone.now()
+                    written_entries += entries_count
+                chunk.save()
+                for next_chunk in itertools.islice(remaining_chunks, 1):
+                    futures[executor.submit(prepare_chunk, next_chunk, session)] = next_chunk
+
+    if written_entries > 0:
+        refresh_invoice_stats(start_date, end_date)
+        refresh_flex_saldo_snapshots()
+
+    Event(
+        event_type="backfill_hour_entries",
+        succeeded=failed_chunks == 0,
+        message=f"Backfill {backfill}: processed {len(pending_chunks)} of {len(chunks)} chunks, {failed_chunks} failed. Added or deleted {written_entries} entries."
+    ).save()
+    return written_entries, failed_chunks
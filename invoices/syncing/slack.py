@@ -1,24 +1,55 @@
+from django.db import transaction
+
 from invoices.models import Event, SlackChannel, TenkfUser
 from invoices.slack import slack
+from invoices.utils import bulk_update
+
+
+def fetch_slack_list(method, key, **params):
+    """Fetch all items from a Slack list method, following cursor pagination"""
+    items = []
+    cursor = None
+    while True:
+        body = slack.api.get(method, params=dict(params, limit=200, cursor=cursor)).body
+        items.extend(body[key])
+        cursor = body.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return items
 
 
 def sync_slack_users(force=False):  # pylint:disable=unused-argument
-    slack_users = slack.users.list().body["members"]
+    slack_users = fetch_slack_list("users.list", "members")
+    users_by_email = {}
+    for user in TenkfUser.objects.only("guid", "email", "slack_id"):
+        users_by_email.setdefault(user.email.lower(), []).append(user)
+    changed = {}
     for member in slack_users:
         email = member.get("profile", {}).get("email")
         if not email:
             continue
-        TenkfUser.objects.filter(email__iexact=email).update(slack_id=member.get("id"))
-    Event(event_type="sync_slack_users", succeeded=True, message=f"Got {len(slack_users)} users from Slack").save()
+        for user in users_by_email.get(email.lower(), []):
+            if user.slack_id != member.get("id"):
+                changed[user.guid] = {"slack_id": member.get("id")}
+    bulk_update(TenkfUser, changed, ["slack_id"])
+    Event(event_type="sync_slack_users", succeeded=True, message=f"Got {len(slack_users)} users from Slack, updated {len(changed)} users").save()
 
 
 def sync_slack_channels(force=False):  # pylint:disable=unused-argument
-    slack_channels = slack.channels.list().body["channels"]
+    slack_channels = fetch_slack_list("channels.list", "channels", exclude_members=True)
+    existing_channels = {channel.channel_id: channel for channel in SlackChannel.objects.all()}
+    new_channels = []
+    changed_channels = {}
     for channel in slack_channels:
         channel_id = channel.get("id")
         channel_name = channel.get("name")
-        SlackChannel.objects.update_or_create(channel_id=channel_id, defaults={
-            "name": channel_name,
-            "archived": channel.get("is_archived", False),
-        })
-    Event(event_type="sync_slack_channels", succeeded=True, message="Got {} channels from Slack".format(len(slack_channels))).save()
+        archived = channel.get("is_archived", False)
+        existing_channel = existing_channels.get(channel_id)
+        if not existing_channel:
+            new_channels.append(SlackChannel(channel_id=channel_id, name=channel_name, archived=archived))
+            continue
+        if existing_channel.name != channel_name or existing_channel.archived != archived:
+            changed_channels[channel_id] = {"name": channel_name, "archived": archived}
+    with transaction.atomic():
+        SlackChannel.objects.bulk_create(new_channels)
+        bulk_update(SlackChannel, changed_channels, ["name", "archived"])
+    Event(event_type="sync_slack_channels", succeeded=True, message=f"Got {len(slack_channels)} channels from Slack, created {len(new_channels)} and updated {len(changed_channels)} channels").save()
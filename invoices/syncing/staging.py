@@ -0,0 +1,82 @@
+"""
+Staging-table ingestion of hour entries.
+
+New hour entries are first loaded to a temporary table outside of the sync transaction, using COPY on PostgreSQL and multi-row INSERTs on other databases. The sync transaction then only runs set-based statements (DELETE and INSERT ... SELECT), so row locks on HourEntry are held for a much shorter time than with bulk_create inside the transaction.
+"""
+import csv
+import io
+import logging
+
+from django.db import connection
+
+from invoices.models import HourEntry
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+STAGING_TABLE = "invoices_hourentry_staging"
+
+
+def get_staging_fields():
+    return [field for field in HourEntry._meta.concrete_fields if not field.primary_key]  # pylint:disable=protected-access
+
+
+def get_staging_columns():
+    return ", ".join(connection.ops.quote_name(field.column) for field in get_staging_fields())
+
+
+def get_row(hour_entry, fields):
+    return [field.get_db_prep_save(getattr(hour_entry, field.attname), connection) for field in fields]
+
+
+def create_staging_table():
+    """(Re)create an empty temporary staging table. It is dropped automatically when the database connection is closed."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+        cursor.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} AS SELECT {get_staging_columns()} FROM {HourEntry._meta.db_table} LIMIT 0")  # pylint:disable=protected-access
+
+
+def load_staging_table(hour_entries, batch_size=1000):
+    """Load HourEntry instances to the staging table, and return the number of loaded rows
+
+    hour_entries can be any iterable, and it is consumed one batch at a time.
+    """
+    fields = get_staging_fields()
+    columns = get_staging_columns()
+    loaded_rows = 0
+    batch = []
+    with connection.cursor() as cursor:
+        for hour_entry in hour_entries:
+            batch.append(get_row(hour_entry, fields))
+            if len(batch) >= batch_size:
+                load_batch(cursor, columns, batch)
+                loaded_rows += len(batch)
+                batch = []
+        if batch:
+            load_batch(cursor, columns, batch)
+            loaded_rows += len(batch)
+    return loaded_rows
+
+
+def load_batch(cursor, columns, batch):
+    if connection.vendor == "postgresql":
+        # QUOTE_NONNUMERIC quotes all strings (including empty ones), so unquoted empty values are NULLs.
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(batch)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        placeholders = ", ".join(["%s"] * len(batch[0]))
+        cursor.executemany(f"INSERT INTO {STAGING_TABLE} ({columns}) VALUES ({placeholders})", batch)
+
+
+def insert_from_staging_table():
+    """Copy all rows from the staging table to HourEntry, and return the number of inserted rows. Must be called inside the swap transaction."""
+    columns = get_staging_columns()
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {HourEntry._meta.db_table} ({columns}) SELECT {columns} FROM {STAGING_TABLE}")  # pylint:disable=protected-access
+        return cursor.rowcount
+
+
+def drop_staging_table():
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
@@ -1,31 +1,97 @@
 import hashlib
 import json
 import logging
+import time
 from collections import defaultdict
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 
 from django.conf import settings
-from django.db import transaction
-from django.db.utils import IntegrityError
-from django.forms.models import model_to_dict
+from django.db import IntegrityError, connection, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Lower
 from django.utils import timezone
 
+from flex_hours.utils import invalidate_flex_saldos, refresh_flex_saldo_snapshots, sync_public_holidays
 from invoices.invoice_utils import calculate_entry_stats, get_aws_entries
+from invoices.locking import DistributedLock, get_date_range_lock_keys, get_invoice_month_lock_keys
 from invoices.models import Client, Event, HourEntry, HourEntryChecksum, Invoice, Project, TenkfUser, is_phase_billable
 from invoices.slack import send_new_project_to_slack
+from invoices.syncing.staging import (create_staging_table, drop_staging_table, insert_from_staging_table,
+                                      load_staging_table)
 from invoices.tenkfeet_api import TenkFeetApi
-from invoices.utils import daterange
+from invoices.utils import bulk_update, daterange
+from slack_hooks.utils import invalidate_unfurls
 
 tenkfeet_api = TenkFeetApi(settings.TENKFEET_AUTH)  # pylint: disable=invalid-name
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def sync_10000ft_users(force: bool = False) -> None:
+class TenkfeetSyncSession(object):
+    """Upstream data for a single sync run
+
+    Each collection is fetched from 10000ft and validated at most once, when it is first needed, and then shared by all sync stages using the same session.
+    """
+
+    def __init__(self, api=None):
+        self.api = api or tenkfeet_api
+        self.collections = {}
+
+    def get_collection(self, name, fetch):
+        if name not in self.collections:
+            self.collections[name] = fetch()
+        return self.collections[name]
+
+    @property
+    def users(self):
+        return self.get_collection("users", self.api.fetch_users)
+
+    def fetch_phases(self):
+        phases, projects = self.api.fetch_phases_and_projects()
+        self.collections["projects"] = projects
+        return phases
+
+    @property
+    def phases(self):
+        """All projects and their phases"""
+        return self.get_collection("phases", self.fetch_phases)
+
+    @property
+    def projects(self):
+        # If phases have been fetched already, projects were taken from the same response.
+        return self.get_collection("projects", self.api.fetch_projects)
+
+    @property
+    def holidays(self):
+        return self.get_collection("holidays", self.api.fetch_holidays)
+
+    @property
+    def leave_types(self):
+        return self.get_collection("leave_types", self.api.fetch_leave_types)
+
+
+def link_orphan_hour_entries():
+    """Link hour entries without a user to users with a matching email address, and return the number of linked entries
+
+    Uses a single UPDATE for all entries. Lower-cased email of entries without a user is indexed (see migration 0100).
+    """
+    orphan_entries = HourEntry.objects.filter(user_m=None).annotate(user_email_lower=Lower("user_email"))
+    user_guids = {user.email.lower(): user.guid for user in TenkfUser.objects.only("guid", "email")}
+    linked_emails = set(orphan_entries.filter(user_email_lower__in=list(user_guids.keys())).values_list("user_email_lower", flat=True).distinct())
+    if not linked_emails:
+        return 0
+    updated_objects = orphan_entries.filter(user_email_lower__in=linked_emails).update(user_m=Subquery(TenkfUser.objects.filter(email__iexact=OuterRef("user_email")).values("guid")[:1]))
+    invalidate_flex_saldos([user_guids[email] for email in linked_emails])
+    return updated_objects
+
+
+def sync_10000ft_users(force: bool = False, session: TenkfeetSyncSession = None) -> None:
     logger.info("Updating users")
-    tenkfeet_users = tenkfeet_api.fetch_users()
-    updated_hour_entries = updated_users = created_users = 0
-    all_users = {str(user["guid"]): user["updated_at"] for user in TenkfUser.objects.values("guid", "updated_at")}
+    tenkfeet_users = (session or TenkfeetSyncSession()).users
+    all_users = {str(user["guid"]): (user["updated_at"], user["email"]) for user in TenkfUser.objects.values("guid", "updated_at", "email")}
+    user_emails = {email: guid for guid, (_, email) in all_users.items()}
+    created_users = {}
+    updated_users = {}
     for user in tenkfeet_users:
         if not user["email"]:
             continue
@@ -33,10 +99,14 @@ def sync_10000ft_users(force: bool = False) -> None:
         updated_at = user["updated_at"]
 
         if user["guid"] in all_users:
-            if all_users[user["guid"]] == updated_at and not force:
+            if all_users[user["guid"]][0] == updated_at and not force:
                 logger.info("Skip updating %s (%s) - update timestamp matches", user["email"], user["guid"])
                 continue
-        logger.info("Updating user %s - %s - %s", user["guid"], all_users.get(user["guid"]), user["updated_at"])
+        logger.info("Updating user %s - %s - %s", user["guid"], all_users.get(user["guid"], (None,))[0], user["updated_at"])
+        if user_emails.get(user_email, user["guid"]) != user["guid"]:
+            logger.info("Unable to update %s - duplicate email", user_email)
+            continue
+        user_emails[user_email] = user["guid"]
 
         user_fields = {
             "user_id": user["id"],
@@ -59,29 +129,62 @@ def sync_10000ft_users(force: bool = False) -> None:
             "discipline": user["discipline"],
         }
         # TODO: always ensure non-archived user is added to the DB
+        if user["guid"] in all_users:
+            updated_users[user["guid"]] = user_fields
+        else:
+            created_users[user["guid"]] = user_fields
+
+    with transaction.atomic():
+        if updated_users:
+            bulk_update(TenkfUser, updated_users, list(next(iter(updated_users.values())).keys()))
+        TenkfUser.objects.bulk_create([TenkfUser(guid=guid, **user_fields) for guid, user_fields in created_users.items()])
+    updated_hour_entries = link_orphan_hour_entries()
+    logger.info("Got %s users from 10000ft, updated %s users, created %s users, linked %s hour entries", len(tenkfeet_users), len(updated_users), len(created_users), updated_hour_entries)
+    Event(event_type="sync_10000ft_users", succeeded=True, message="Got {} users from 10000ft, updated {} users, created {} users, linked {} hour entries".format(len(tenkfeet_users), len(updated_users), len(created_users), updated_hour_entries)).save()
+
+
+def get_project_admin_users(tags, users_by_name, project_id):
+    """Return guids of non-archived users matching "first_name last_name" tags of a project"""
+    admin_users = set()
+    for tag in tags:
         try:
-            user_obj, created = TenkfUser.objects.update_or_create(guid=user["guid"], defaults=user_fields)
-            if created:
-                created_users += 1
-            else:
-                updated_users += 1
-        except IntegrityError:
-            logger.info("Unable to update %s - duplicate email", user_email)
+            first_name, last_name = tag["value"].split(" ", 1)
+        except ValueError:
+            logger.info("Invalid tag: %s for %s", tag, project_id)
             continue
-        updated_objects = HourEntry.objects.filter(user_email__iexact=user_email).filter(user_m=None).update(user_m=user_obj)
-        logger.debug("Updated %s to %s entries", user_email, updated_objects)
-        updated_hour_entries += updated_objects
-    logger.info("Got %s users from 10000ft, updated %s users, created %s users, linked %s hour entries", len(tenkfeet_users), updated_users, created_users, updated_hour_entries)
-    Event(event_type="sync_10000ft_users", succeeded=True, message="Got {} users from 10000ft, updated {} users, created {} users, linked {} hour entries".format(len(tenkfeet_users), updated_users, created_users, updated_hour_entries)).save()
+        matching_users = users_by_name.get((first_name, last_name), [])
+        logger.debug("Matched %s to tag %s; first_name=%s, last_name=%s", matching_users, tag, first_name, last_name)
+        admin_users.update(matching_users)
+    return admin_users
 
 
-def sync_10000ft_projects(force=False):  # pylint: disable=unused-argument
+def sync_10000ft_projects(force=False, session=None):
     logger.info("Updating projects")
-    tenkfeet_projects = tenkfeet_api.fetch_projects()
-    projects = []
-    created_count = 0
+    tenkfeet_projects = (session or TenkfeetSyncSession()).projects
     clients = {client.name: client for client in Client.objects.all()}
+    all_projects = {str(guid): updated_at for guid, updated_at in Project.objects.values_list("guid", "updated_at")}
+    users_by_name = defaultdict(list)
+    for guid, first_name, last_name in TenkfUser.objects.filter(archived=False).values_list("guid", "first_name", "last_name"):
+        users_by_name[(first_name, last_name)].append(guid)
+    current_admin_users = defaultdict(set)
+    for project_id, user_id in Project.admin_users.through.objects.values_list("project_id", "tenkfuser_id"):
+        current_admin_users[str(project_id)].add(user_id)
+
+    created_projects = {}
+    updated_projects = {}
+    added_admin_users = []
+    removed_admin_users = defaultdict(set)
     for project in tenkfeet_projects:
+        if project["tags"]["data"]:
+            # Admin users of projects without tags are left untouched.
+            admin_users = get_project_admin_users(project["tags"]["data"], users_by_name, project["id"])
+            for user_id in admin_users - current_admin_users[project["guid"]]:
+                added_admin_users.append(Project.admin_users.through(project_id=project["guid"], tenkfuser_id=user_id))
+            for user_id in current_admin_users[project["guid"]] - admin_users:
+                removed_admin_users[project["guid"]].add(user_id)
+
+        if project["guid"] in all_projects and all_projects[project["guid"]] == project["updated_at"] and project["updated_at"] and not force:
+            continue
         if project["client"] is None:
             project["client"] = "none"
         client = clients.get(project["client"])
@@ -102,44 +205,67 @@ def sync_10000ft_projects(force=False):  # pylint: disable=unused-argument
             "starts_at": project["starts_at"],
             "ends_at": project["ends_at"],
             "thumbnail_url": project["thumbnail"],
+            "updated_at": project["updated_at"],
         }
-        project_obj, created = Project.objects.update_or_create(guid=project["guid"], defaults=project_fields)
-        user_cache = {}
-
-        for tag in project["tags"]["data"]:
-            tag_value = tag["value"]
-            if tag_value in user_cache:
-                matching_users = user_cache[tag_value]
-            else:
-                try:
-                    first_name, last_name = tag_value.split(" ", 1)
-                except ValueError:
-                    logger.info("Invalid tag: %s for %s", tag, project["id"])
-                    continue
-                matching_users = TenkfUser.objects.filter(first_name=first_name, last_name=last_name).filter(archived=False)
-                logger.debug("Matched %s to tag %s; first_name=%s, last_name=%s", matching_users, tag, first_name, last_name)
-                user_cache[tag_value] = matching_users
-
-            with transaction.atomic():
-                project_obj.admin_users.clear()
-                for matching_user in matching_users:
-                    project_obj.admin_users.add(matching_user)
-        project_obj.save()
-        projects.append(project_obj)
-        if created:
-            created_count += 1
-            send_new_project_to_slack(project_obj)
-    logger.info("Finished updating projects (n=%s)", len(projects))
+        if project["guid"] in all_projects:
+            updated_projects[project["guid"]] = dict(project_fields, client_m=client.id)
+        else:
+            created_projects[project["guid"]] = project_fields
+
+    with transaction.atomic():
+        if updated_projects:
+            bulk_update(Project, updated_projects, list(next(iter(updated_projects.values())).keys()))
+        new_projects = Project.objects.bulk_create([Project(guid=guid, **project_fields) for guid, project_fields in created_projects.items()])
+        for project_guid, user_ids in removed_admin_users.items():
+            Project.admin_users.through.objects.filter(project_id=project_guid, tenkfuser_id__in=user_ids).delete()
+        Project.admin_users.through.objects.bulk_create(added_admin_users)
+    invalidate_unfurls(project_guids=set(updated_projects.keys()) | set(removed_admin_users.keys()) | {str(row.project_id) for row in added_admin_users})
+    for project_obj in new_projects:
+        send_new_project_to_slack(project_obj)
+    logger.info("Finished updating projects (n=%s)", len(tenkfeet_projects))
     linked_invoices = 0
-    Event(event_type="sync_10000ft_projects", succeeded=True, message=f"Updated {len(projects)} projects, created {created_count} projects and linked {linked_invoices} invoices to projects").save()
+    Event(event_type="sync_10000ft_projects", succeeded=True, message=f"Updated {len(updated_projects)} projects, created {len(created_projects)} projects, changed {len(added_admin_users) + sum(len(user_ids) for user_ids in removed_admin_users.values())} project admins and linked {linked_invoices} invoices to projects").save()
 
 
 def get_projects():
     return {project.project_id: project for project in Project.objects.all()}
 
 
-def get_invoices():
-    return {f"{invoice.date:%Y-%m} {invoice.project_m.project_id}": invoice for invoice in Invoice.objects.all()}  # TODO: cache key is hardcoded
+def get_projects_by_name():
+    """Return {(client name, project name): project}. If names are not unique, the project with the smallest 10000ft ID is used."""
+    projects = {}
+    for project in Project.objects.select_related("client_m").order_by("project_id"):
+        projects.setdefault((project.client_m.name, project.name), project)
+    return projects
+
+
+def get_invoices(start_date, end_date):
+    """Return {(month, project guid): invoice} for invoices between start_date and end_date"""
+    invoices = Invoice.objects.filter(date__gte=start_date.replace(day=1), date__lte=end_date).select_related("project_m")
+    return {(invoice.date, invoice.project_m_id): invoice for invoice in invoices}
+
+
+def create_invoices(invoices):
+    """Insert new (unsaved) invoices in bulk, and return the number of created invoices
+
+    If another process has created some of the invoices in the meantime, these are not inserted again. Instead, the primary key of the in-memory invoice is changed to point to the existing one, so hour entries referring to it are linked to the existing invoice.
+    """
+    if not invoices:
+        return 0
+    try:
+        with transaction.atomic():
+            Invoice.objects.bulk_create(invoices)
+        return len(invoices)
+    except IntegrityError:
+        logger.info("Some of the %s new invoices were created concurrently - creating only the missing ones", len(invoices))
+    invoices_by_key = {(invoice.date, invoice.project_m_id): invoice for invoice in invoices}
+    existing_invoices = Invoice.objects.filter(date__in={invoice.date for invoice in invoices}, project_m__in={invoice.project_m_id for invoice in invoices})
+    for existing_invoice in existing_invoices:
+        invoice = invoices_by_key.pop((existing_invoice.date, existing_invoice.project_m_id), None)
+        if invoice:
+            invoice.invoice_id = existing_invoice.invoice_id
+    Invoice.objects.bulk_create(invoices_by_key.values())
+    return len(invoices_by_key)
 
 
 def get_users():
@@ -164,9 +290,9 @@ class DateTimeEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
-def fetch_assignables():
+def fetch_assignables(session):
     result = {}
-    phases = {phase["id"]: phase for phase in tenkfeet_api.fetch_phases()}
+    phases = {phase["id"]: phase for phase in session.phases}
 
     for id, phase in phases.items():
         if phase.get("parent_id"):
@@ -183,15 +309,69 @@ def fetch_assignables():
     return result
 
 
-def fetch_leave_types():
-    return {a['id']: a['name'] for a in tenkfeet_api.fetch_leave_types()}
+def fetch_leave_types(session):
+    return {a['id']: a['name'] for a in session.leave_types}
+
+
+class HourEntryRecord(object):
+    """Compact representation of a merged 10000ft time entry
+
+    Records only hold the fields stored to HourEntry. HourEntry instances are created from these one batch at a time, right before inserting them to the database.
+    """
+    __slots__ = (
+        "date", "user_id", "user_name", "assignable_id", "approved_at", "upstream_id", "approved_by", "submitted_by",
+        "updated_at", "created_at", "project", "client", "incurred_hours", "incurred_money", "category", "notes",
+        "entry_type", "discipline", "role", "bill_rate", "leave_type", "phase_name", "billable", "approved", "status",
+        "user_email", "last_updated_at", "calculated_is_billable", "upstream_approvable_id",
+        "upstream_approvable_updated_at", "invoice", "user_m",
+    )
+
+    def __init__(self, **fields):
+        self.invoice = self.user_m = None
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return f"<HourEntryRecord upstream_id={self.upstream_id} date={self.date} client={self.client} project={self.project}>"
+
+    def to_hour_entry(self):
+        hour_entry = HourEntry(**{field: getattr(self, field) for field in self.__slots__})
+        hour_entry.update_calculated_fields()
+        return hour_entry
+
+
+def upsert_checksums(checksums, batch_size=1000):
+    """Insert or update HourEntryChecksum rows. Dates of checksums must be unique."""
+    if connection.vendor not in ("postgresql", "sqlite"):
+        HourEntryChecksum.objects.filter(date__in=[checksum.date for checksum in checksums]).delete()
+        HourEntryChecksum.objects.bulk_create(checksums, batch_size=batch_size)
+        return
+    table = HourEntryChecksum._meta.db_table  # pylint:disable=protected-access
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(["date", "sha256"], checksums))
+    with connection.cursor() as cursor:
+        for i in range(0, len(checksums), batch_size):
+            batch = checksums[i:i + batch_size]
+            placeholders = ", ".join(["(%s, %s)"] * len(batch))
+            params = [value for checksum in batch for value in (checksum.date, checksum.sha256)]
+            if connection.vendor == "postgresql":
+                cursor.execute(f"INSERT INTO {table} (date, sha256) VALUES {placeholders} ON CONFLICT (date) DO UPDATE SET sha256 = EXCLUDED.sha256", params)
+            else:
+                cursor.execute(f"INSERT OR REPLACE INTO {table} (date, sha256) VALUES {placeholders}", params)
 
 
 class HourEntryUpdate(object):
-    def __init__(self, start_date, end_date):
+    BULK_CREATE_BATCH_SIZE = 1000
+
+    def __init__(self, start_date, end_date, session=None, staging=None, force=False):
         self.logger = logging.getLogger(__name__)
-        self.invoices_data = get_invoices()
+        self.force = force  # Ignore stored checksums, and replace entries for all dates
+        self.staging = settings.HOUR_ENTRY_STAGING if staging is None else staging
+        self.session = session or TenkfeetSyncSession()
+        self.invoices_data = get_invoices(start_date, end_date)
+        self.new_invoices = []
         self.projects_data = get_projects()
+        self.projects_by_name = get_projects_by_name()
+        self.missing_projects = defaultdict(int)
         self.clients_data = get_clients()
         self.leave_project = Project.objects.get(name="[Leave Type]")  # TODO: this should not be hardcoded
         self.user_data = get_users()
@@ -199,6 +379,10 @@ class HourEntryUpdate(object):
         self.end_date = end_date
         self.first_entry = date(2100, 1, 1)
         self.last_entry = date(1970, 1, 1)
+        self.now = None
+        self.records = []
+        self.delete_days = set()
+        self.checksum_updates = []
 
     def update_range(self, date):
         self.last_entry = max(self.last_entry, date)
@@ -216,10 +400,10 @@ class HourEntryUpdate(object):
             if project in ["[Leave Type]", "LeaveType"]:  # TODO: this should not be hardcoded
                 return self.leave_project
             # 10000ft returns some entries without project IDs
-            try:
-                return Project.objects.get(name=project, client_m__name=client)
-            except Project.DoesNotExist:
-                return None
+            project_m = self.projects_by_name.get((client, project))
+            if not project_m:
+                self.missing_projects[(client, project)] += 1
+            return project_m
         return self.projects_data.get(project_id, None)
 
     def match_invoice(self, date, project_id, client, project):
@@ -228,20 +412,27 @@ class HourEntryUpdate(object):
         if not project_m:
             return None
 
-        invoice_key = f"{date:%Y-%m} {project_id}"  # TODO: cache key is hardcoded
+        invoice_key = (date, project_m.guid)
         invoice = self.invoices_data.get(invoice_key)
         if invoice:
             logger.debug("Invoice already exists: %s - project_m=%s", date, project_m)
             return invoice
+        # New invoices are created in bulk (see create_invoices) before hour entries are inserted.
         logger.info("Creating a new invoice: %s - project_m=%s", date, project_m)
-        invoice, _ = Invoice.objects.update_or_create(date=date, project_m=project_m)
+        invoice = Invoice(date=date, project_m=project_m)
         self.invoices_data[invoice_key] = invoice
+        self.new_invoices.append(invoice)
         return invoice
 
     def match_user(self, email):
         return self.user_data.get(email)
 
-    def update(self):
+    def update(self, lock=None):
+        self.prepare()
+        return self.write(lock=lock)
+
+    def prepare(self):
+        """Fetch and merge entries from 10000ft without writing anything to HourEntry. This can be run in parallel for non-overlapping date ranges."""
         def fetch_per_date_data():
             date_data = defaultdict(lambda: {"items": [], "sha256": hashlib.sha256()})
             for entry in tenkfeet_api.fetch_api_hour_entries(self.start_date, self.end_date):
@@ -283,185 +474,268 @@ class HourEntryUpdate(object):
             assignable = assignables.get(entry["assignable_id"]) or {}
             project = assignable.get("project") or {}
 
-            data = {
-                "date": entry["date"],
-                "user_id": entry["user_id"],
-                "user_name": user["display_name"],
-                "assignable_id": entry["assignable_id"],
-                "approved_at": datetime_to_date(approval.get("approved_at")),
-                "upstream_id": entry["id"],
-                "approved_by": approval.get("approved_by"),
-                "submitted_by": approval.get("submitted_by"),
-                "updated_at": entry.get("updated_at"),
-                "created_at": entry.get("created_at"),
-                "project": project.get("name") or "[Leave Type]",
-                "client": project.get("client") or "[none]",
-                "incurred_hours": entry["hours"],
-                "incurred_money": entry["bill_rate"] * entry["hours"],
-                "category": entry.get("task") or "[none]",
-                "notes": entry.get("notes"),
-                "entry_type": "Confirmed" if not entry["is_suggestion"] else "Suggestion",
-                "discipline": user.get("discipline") or "[none]",
-                "role": user.get("role") or "[none]",
-                "bill_rate": entry["bill_rate"],
-                "leave_type": legacy_leave_type(),
-                "phase_name": assignable.get("phase", {}).get("phase_name") or "[Non Phase Specific]",
-                "billable": is_phase_billable(
+            data = HourEntryRecord(
+                date=entry["date"],
+                user_id=entry["user_id"],
+                user_name=user["display_name"],
+                assignable_id=entry["assignable_id"],
+                approved_at=datetime_to_date(approval.get("approved_at")),
+                upstream_id=entry["id"],
+                approved_by=approval.get("approved_by"),
+                submitted_by=approval.get("submitted_by"),
+                updated_at=entry.get("updated_at"),
+                created_at=entry.get("created_at"),
+                project=project.get("name") or "[Leave Type]",
+                client=project.get("client") or "[none]",
+                incurred_hours=entry["hours"],
+                incurred_money=entry["bill_rate"] * entry["hours"],
+                category=entry.get("task") or "[none]",
+                notes=entry.get("notes"),
+                entry_type="Confirmed" if not entry["is_suggestion"] else "Suggestion",
+                discipline=user.get("discipline") or "[none]",
+                role=user.get("role") or "[none]",
+                bill_rate=entry["bill_rate"],
+                leave_type=legacy_leave_type(),
+                phase_name=assignable.get("phase", {}).get("phase_name") or "[Non Phase Specific]",
+                billable=is_phase_billable(
                     phase_name="",
                     project=project.get("name") or "[Leave Type]"
                 ),  # TODO Check what is this value and is it meaningful at all. Only 'billable' in API is from user
-                "approved": approval is not None,
-                "status": status(approval),
-                "user_email": user["email"].lower(),
-                "last_updated_at": now,
-                "calculated_is_billable": is_phase_billable(
+                approved=approval is not None,
+                status=status(approval),
+                user_email=user["email"].lower(),
+                last_updated_at=now,
+                calculated_is_billable=is_phase_billable(
                     phase_name=assignable.get("phase", {}).get("phase_name") or "[Non Phase Specific]",
                     project=project.get("name") or "[Leave Type]"
                 ),
-                "upstream_approvable_id": approval.get("id"),
-                "upstream_approvable_updated_at": approval.get("updated_at"),
-            }
+                upstream_approvable_id=approval.get("id"),
+                upstream_approvable_updated_at=approval.get("updated_at"),
+            )
 
-            assert data["date"].year > 2000
-            assert data["date"].year < 2050
-            assert data["bill_rate"] >= 0
-            assert data["incurred_money"] >= 0
-            assert data["incurred_hours"] >= 0
+            assert data.date.year > 2000
+            assert data.date.year < 2050
+            assert data.bill_rate >= 0
+            assert data.incurred_money >= 0
+            assert data.incurred_hours >= 0
 
             # Reset billing rates and money for all leaves
-            if data["leave_type"] != "[project]":
-                data["incurred_money"] = data["bill_rate"] = 0
+            if data.leave_type != "[project]":
+                data.incurred_money = data.bill_rate = 0
 
             return data
 
         self.logger.info("Starting hour entry update: %s - %s", self.start_date, self.end_date)
 
-        users = {user.user_id: model_to_dict(user) for user in TenkfUser.objects.all()}
+        users = {user["user_id"]: user for user in TenkfUser.objects.values("user_id", "display_name", "email", "role", "discipline")}
 
         self.logger.info("Fetch assignables.")
-        assignables = fetch_assignables()  # TODO cache this
-        leave_types = fetch_leave_types()  # TODO cache this
+        assignables = fetch_assignables(self.session)
+        leave_types = fetch_leave_types(self.session)
 
         self.logger.info("Fetch per date data.")
         per_date_data = fetch_per_date_data()
         dates = list(daterange(self.start_date, self.end_date))
-        checksums = {k.date: k.sha256 for k in HourEntryChecksum.objects.filter(date__in=dates)}
+        if self.force:
+            checksums = {}
+        else:
+            checksums = {k.date: k.sha256 for k in HourEntryChecksum.objects.filter(date__in=dates)}
 
         now = timezone.now()
-        entries = []
+        records = []
         delete_days = set()
         updated_days = set()
         checksum_updates = []
         for date in dates:
-            if date not in per_date_data:
+            # Raw entries are dropped as soon as the day has been processed.
+            date_data = per_date_data.pop(date, None)
+            if not date_data:
                 logger.info("No entries for %s - delete all existing entries.", date)
                 delete_days.add(date)
             else:
-                sha256 = per_date_data[date]["sha256"].hexdigest()
+                sha256 = date_data["sha256"].hexdigest()
                 if checksums.get(date) != sha256:
                     logger.info("Something changed for %s", date)
 
-                    for entry in per_date_data[date]["items"]:
+                    for entry in date_data["items"]:
                         data = merge_data(entry, users, assignables, leave_types)
                         project_id = assignables\
                             .get(entry["assignable_id"], {})\
                             .get("project", {})\
                             .get("id")
 
-                        self.update_range(data["date"])
+                        self.update_range(data.date)
 
                         invoice = self.match_invoice(
-                            date=data["date"],
+                            date=data.date,
                             project_id=project_id,
-                            client=data["client"],
-                            project=data["project"]
+                            client=data.client,
+                            project=data.project
                         )
 
                         if not invoice:
                             logger.warning("No matching invoice available - skip entry. data=%s; entry=%s", data, entry)
                             sha256 = "-" * 64  # Reset checksum to ensure reprocessing
                         else:
-                            data["invoice"] = invoice
-                            data["user_m"] = self.match_user(data["user_email"])
-                            hour_entry = HourEntry(**data)
-                            hour_entry.update_calculated_fields()
-                            entries.append(hour_entry)
-                            delete_days.add(data["date"])
-                            updated_days.add(data["date"])
-
-                    checksum_updates.append({"date": date, "defaults": {"sha256": sha256}})
+                            data.invoice = invoice
+                            data.user_m = self.match_user(data.user_email)
+                            records.append(data)
+                            delete_days.add(data.date)
+                            updated_days.add(data.date)
+
+                    checksum_updates.append(HourEntryChecksum(date=date, sha256=sha256))
                 else:
                     logger.info("Nothing was changed for %s - skip updating", date)
 
-        logger.info("Processed all 10k entries. Inserting %s entries to database.", len(entries))
+        logger.info("Processed all 10k entries: %s entries to insert.", len(records))
+        self.now = now
+        self.records = records
+        self.delete_days = delete_days
+        self.checksum_updates = checksum_updates
+
+    def write(self, lock=None):
+        """Replace entries in the database with prepared entries. Writes must not be run in parallel for overlapping date ranges.
+
+        lock is the DistributedLock for the dates being written, if any. If the lock was lost, LockLost is raised and nothing is committed.
+        """
+        now, records, delete_days, checksum_updates = self.now, self.records, self.delete_days, self.checksum_updates
+        logger.info("Inserting %s entries to database.", len(records))
+
+        created_invoices = 0
+        if self.staging:
+            # Invoices are created before staging, as create_invoices may point new invoices to concurrently created ones.
+            created_invoices = create_invoices(self.new_invoices)
+            self.new_invoices = []
+            logger.info("Loading %s entries to the staging table.", len(records))
+            create_staging_table()
+            load_staging_table((record.to_hour_entry() for record in records), batch_size=self.BULK_CREATE_BATCH_SIZE)
 
         # It is very important to run these operations inside a transaction to avoid non-consistent views.
+        if lock:
+            lock.check()
+        transaction_started_at = time.monotonic()
         with transaction.atomic():
+            created_invoices += create_invoices(self.new_invoices)
+            logger.info("Created %s new invoices.", created_invoices)
+
             logger.info("Deleting old 10k entries.")
-            deleted_entries, _ = HourEntry.objects.filter(
+            deleted_hour_entries = HourEntry.objects.filter(
                 date__gte=self.first_entry,
                 date__lte=self.last_entry,
                 date__in=list(delete_days),
                 last_updated_at__lt=now
-            ).delete()
+            )
+            updated_users = set(deleted_hour_entries.exclude(user_m=None).values_list("user_m", flat=True).distinct())
+            deleted_entries, _ = deleted_hour_entries.delete()
 
             logger.info("Update hour entry checksums.")
-            for checksum in checksum_updates:
-                HourEntryChecksum.objects.update_or_create(date=checksum["date"], defaults=checksum["defaults"])
+            upsert_checksums(checksum_updates, batch_size=self.BULK_CREATE_BATCH_SIZE)
 
             logger.info("All old 10k entries deleted: %s.", deleted_entries)
             # Note: this does not call .save() for entries.
-            HourEntry.objects.bulk_create(entries)
-            logger.info("All 10k entries added: %s.", len(entries))
+            if self.staging:
+                insert_from_staging_table()
+            else:
+                for i in range(0, len(records), self.BULK_CREATE_BATCH_SIZE):
+                    entries = [record.to_hour_entry() for record in records[i:i + self.BULK_CREATE_BATCH_SIZE]]
+                    HourEntry.objects.bulk_create(entries, batch_size=self.BULK_CREATE_BATCH_SIZE)
+            logger.info("All 10k entries added: %s.", len(records))
+            if lock:
+                # Another sync may have started writing the same dates if the lock was lost during the transaction.
+                lock.check()
+        transaction_duration = time.monotonic() - transaction_started_at
+        logger.info("Hour entry update transaction took %.3fs (staging=%s)", transaction_duration, self.staging)
+        if self.staging:
+            drop_staging_table()
+
+        updated_users.update(record.user_m.pk for record in records if record.user_m)
+        invalidate_flex_saldos(updated_users)
+
+        if self.missing_projects:
+            logger.warning("No matching project for %s entries without a project ID: %s", sum(self.missing_projects.values()), ", ".join(f"{client} / {project}" for client, project in self.missing_projects))
 
         Event(
             event_type="sync_10000ft_report_hours",
             succeeded=True,
-            message="Entries between {:%Y-%m-%d} and {:%Y-%m-%d}. Added {}, deleted {}; processed dates: {}.".format(
+            message="Entries between {:%Y-%m-%d} and {:%Y-%m-%d}. Added {}, deleted {}; created {} invoices; {} entries for {} unknown projects without a project ID; transaction took {:.3f}s (staging={}); processed dates: {}.".format(
                 self.start_date,
                 self.end_date,
-                len(entries),
+                len(records),
                 deleted_entries,
+                created_invoices,
+                sum(self.missing_projects.values()),
+                len(self.missing_projects),
+                transaction_duration,
+                self.staging,
                 ", ".join([day.strftime("%Y-%m-%d") for day in delete_days]))
         ).save()
 
-        return (self.first_entry, self.last_entry, deleted_entries + len(entries))
+        return (self.first_entry, self.last_entry, deleted_entries + len(records))
+
+
+def sync_10000ft_all(force=False, start_date=None, end_date=None):
+    """Sync users, projects, public holidays and hour entries, fetching each upstream collection only once"""
+    session = TenkfeetSyncSession()
+    # Phases are needed for hour entries. Fetching these first also provides projects, so the project list is not fetched separately.
+    logger.info("Fetched %s phases", len(session.phases))
+    sync_10000ft_users(force=force, session=session)
+    sync_10000ft_projects(force=force, session=session)
+    sync_public_holidays(holidays=session.holidays)
+    start_date = start_date or date.today() - timedelta(days=60)
+    end_date = end_date or date.today() + timedelta(days=2)
+    # Same per-day locks as data update jobs (see invoices.job_queue), so this does not overlap with syncs run by process_update_queue workers.
+    with DistributedLock(get_date_range_lock_keys(start_date, end_date)) as lock:
+        _, _, updated_entries_count = HourEntryUpdate(start_date, end_date, session=session, force=force).update(lock=lock)
+    if updated_entries_count > 0:
+        refresh_invoice_stats(start_date, end_date)
+        refresh_flex_saldo_snapshots()
 
 
 def refresh_invoice_stats(start_date, end_date):
     if start_date and end_date:
+        # Invoices are monthly, and hour entries of the whole month affect the statistics.
+        start_date = start_date.replace(day=1)
         invoices = Invoice.objects.filter(date__gte=start_date, date__lte=end_date)
-        logger.info("Updating statistics for invoices between %s and %s: %s invoices", start_date, end_date, len(invoices))
+        lock_keys = get_invoice_month_lock_keys(start_date, end_date)
+        logger.info("Updating statistics for invoices between %s and %s", start_date, end_date)
     else:
-        logger.info("Updating statistics for all invoices")
         invoices = Invoice.objects.all()
+        lock_keys = [key for month in invoices.dates("date", "month") for key in get_invoice_month_lock_keys(month, month)]
+        logger.info("Updating statistics for all invoices")
     invoice_count = 0
-    for invoice in invoices:
-        invoice_count += 1
-        entries = HourEntry.objects.exclude(status="Unsubmitted").filter(invoice=invoice).filter(incurred_hours__gt=0)
-        aws_entries = None
-        if invoice.project_m:
-            aws_accounts = invoice.project_m.amazon_account.all()
-            aws_entries = get_aws_entries(aws_accounts, invoice.month_start_date, invoice.month_end_date)
-        stats = calculate_entry_stats(entries, invoice.get_fixed_invoice_rows(), aws_entries)
-        for field in Invoice.STATS_FIELDS:
-            setattr(invoice, field, stats[field])
-
-        invoice.incurred_money = sum([row["incurred_money"] for row in stats["total_rows"].values() if "incurred_money" in row])
-        invoice.incurred_hours = sum([row["incurred_hours"] for row in stats["total_rows"].values() if "incurred_hours" in row])
-        invoice.incurred_billable_hours = stats["total_rows"]["hours"]["incurred_billable_hours"]
-        if invoice.incurred_hours > 0:
-            invoice.billable_percentage = invoice.incurred_billable_hours / invoice.incurred_hours
-        else:
-            invoice.billable_percentage = 0
-        if stats["total_rows"]["hours"]["incurred_hours"] > 0:
-            invoice.bill_rate_avg = stats["total_rows"]["hours"]["incurred_money"] / stats["total_rows"]["hours"]["incurred_hours"]
-        else:
-            invoice.bill_rate_avg = 0
-        invoice.save()
-        logger.debug("Updated statistics for %s", invoice)
+    if lock_keys:
+        # Statistics of a month are refreshed by one process at a time. Otherwise, a process that read hour entries before another process committed its changes could save stale statistics after the other one.
+        with DistributedLock(lock_keys):
+            for invoice in invoices:
+                invoice_count += 1
+                update_invoice_stats(invoice)
     if start_date and end_date:
         message = f"Refreshed {invoice_count} invoices between {start_date:%Y-%m-%d} and {end_date:%Y-%m-%d}."
     else:
         message = f"Refreshed {invoice_count} invoices (without date range)."
     Event(event_type="refresh_invoice_statistics", succeeded=True, message=message).save()
+
+
+def update_invoice_stats(invoice):
+    entries = HourEntry.objects.exclude(status="Unsubmitted").filter(invoice=invoice).filter(incurred_hours__gt=0)
+    aws_entries = None
+    if invoice.project_m:
+        aws_accounts = invoice.project_m.amazon_account.all()
+        aws_entries = get_aws_entries(aws_accounts, invoice.month_start_date, invoice.month_end_date)
+    stats = calculate_entry_stats(entries, invoice.get_fixed_invoice_rows(), aws_entries)
+    for field in Invoice.STATS_FIELDS:
+        setattr(invoice, field, stats[field])
+
+    invoice.incurred_money = sum([row["incurred_money"] for row in stats["total_rows"].values() if "incurred_money" in row])
+    invoice.incurred_hours = sum([row["incurred_hours"] for row in stats["total_rows"].values() if "incurred_hours" in row])
+    invoice.incurred_billable_hours = stats["total_rows"]["hours"]["incurred_billable_hours"]
+    if invoice.incurred_hours > 0:
+        invoice.billable_percentage = invoice.incurred_billable_hours / invoice.incurred_hours
+    else:
+        invoice.billable_percentage = 0
+    if stats["total_rows"]["hours"]["incurred_hours"] > 0:
+        invoice.bill_rate_avg = stats["total_rows"]["hours"]["incurred_money"] / stats["total_rows"]["hours"]["incurred_hours"]
+    else:
+        invoice.bill_rate_avg = 0
+    invoice.save()
+    logger.debug("Updated statistics for %s", invoice)
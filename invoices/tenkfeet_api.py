@@ -4,6 +4,7 @@ import requests
 import schema
 from schema import And, Or, Schema, Use
 
+from invoices.compiled_schema import CompiledSchema
 from invoices.utils import parse_date, parse_datetime, parse_float
 
 
@@ -14,7 +15,7 @@ def opt(t):
 class TenkFeetApi(object):
     API_HOST = "https://api.10000ft.com"
 
-    USERS_SCHEMA = Schema([{
+    USERS_SCHEMA = CompiledSchema(Schema([{
         "account_owner": bool,
         "archived": bool,
         "archived_at": opt(Use(parse_datetime)),
@@ -46,7 +47,7 @@ class TenkFeetApi(object):
         "updated_at": opt(Use(parse_datetime)),
         "user_settings": int,
         "user_type_id": int
-    }])
+    }]))
 
     PROJECT_SCHEMA = Schema({
         "archived": bool,
@@ -85,9 +86,9 @@ class TenkFeetApi(object):
         "use_parent_bill_rates": bool
     })
 
-    PROJECTS_SCHEMA = Schema([PROJECT_SCHEMA])
+    PROJECTS_SCHEMA = CompiledSchema(Schema([PROJECT_SCHEMA]))
 
-    PHASES_SCHEMA = Schema([{
+    PHASES_SCHEMA = CompiledSchema(Schema([{
         "archived": bool,
         "archived_at": opt(Use(parse_datetime)),
         "client": opt(str),
@@ -122,9 +123,9 @@ class TenkFeetApi(object):
         "type": str,
         "updated_at": opt(Use(parse_datetime)),
         "use_parent_bill_rates": bool
-    }])
+    }]))
 
-    TIME_ENTRIES_SCHEMA = Schema([{
+    TIME_ENTRIES_SCHEMA = CompiledSchema(Schema([{
         "id": int,
         "assignable_id": int,
         "assignable_type": str,
@@ -160,7 +161,7 @@ class TenkFeetApi(object):
                 "self": str,
             }
         }
-    }])
+    }]))
 
     def __init__(self, apikey):
         self.apikey = apikey
@@ -178,13 +179,17 @@ class TenkFeetApi(object):
             params={"auth": self.apikey}
         ).json()
 
-    def fetch_endpoint(self, next_page):
+    def fetch_endpoint(self, next_page, validator=None):
+        """Fetch all pages from an endpoint. If validator is given, each page is validated as soon as it is fetched."""
         entries = []
         while next_page:
             self.logger.debug("Processing page %s", next_page)
             tenkfeet_data = requests.get(self.API_HOST + next_page, params={"auth": self.apikey}).json()
             next_page = tenkfeet_data["paging"]["next"]
-            entries.extend(tenkfeet_data["data"])
+            if validator:
+                entries.extend(validator.validate(tenkfeet_data["data"]))
+            else:
+                entries.extend(tenkfeet_data["data"])
 
         self.logger.info("Fetched %s entries from 10kf", len(entries))
         return entries
@@ -195,21 +200,27 @@ class TenkFeetApi(object):
 
     def fetch_api_hour_entries(self, start_date, end_date):
         self.logger.info("Fetching hour entries from the API: %s - %s", start_date, end_date)
-        return self.TIME_ENTRIES_SCHEMA.validate(self.fetch_endpoint(
-            f"/api/v1/time_entries?fields=approvals&from={start_date:%Y-%m-%d}&to={end_date:%Y-%m-%d}&per_page=10000"
-        ))
+        return self.fetch_endpoint(
+            f"/api/v1/time_entries?fields=approvals&from={start_date:%Y-%m-%d}&to={end_date:%Y-%m-%d}&per_page=10000",
+            validator=self.TIME_ENTRIES_SCHEMA
+        )
 
     def fetch_projects(self):
         self.logger.info("Fetching projects")
-        return self.PROJECTS_SCHEMA.validate(self.fetch_endpoint(
-            "/api/v1/projects?per_page=1000&with_archived=true"
-        ))
+        return self.fetch_endpoint(
+            "/api/v1/projects?per_page=1000&with_archived=true",
+            validator=self.PROJECTS_SCHEMA
+        )
 
-    def fetch_phases(self):
+    def fetch_phases_and_projects(self):
+        """Fetch all projects with their phases, and return (phases, projects)
+
+        Projects are the top level entries of the phases list. These are validated with the stricter PROJECTS_SCHEMA, so the result is the same as from fetch_projects.
+        """
         self.logger.info("Fetching phases")
-        return self.PHASES_SCHEMA.validate(self.fetch_endpoint(
-            "/api/v1/projects?per_page=1000&with_archived=true&with_phases=true"
-        ))
+        entries = self.fetch_endpoint("/api/v1/projects?per_page=1000&with_archived=true&with_phases=true")
+        projects = self.PROJECTS_SCHEMA.validate([entry for entry in entries if not entry.get("parent_id")])
+        return self.PHASES_SCHEMA.validate(entries), projects
 
     def fetch_project(self, project_id):
         return self.PROJECT_SCHEMA.validate(
@@ -221,9 +232,10 @@ class TenkFeetApi(object):
 
     def fetch_users(self):
         self.logger.info("Fetching users")
-        return self.USERS_SCHEMA.validate(self.fetch_endpoint(
-            "/api/v1/users?per_page=1000&with_archived=true"
-        ))
+        return self.fetch_endpoint(
+            "/api/v1/users?per_page=1000&with_archived=true",
+            validator=self.USERS_SCHEMA
+        )
 
     def fetch_leave_types(self):
         self.logger.info("Fetching leave types")
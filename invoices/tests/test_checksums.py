@@ -0,0 +1,32 @@
+import datetime
+
+from django.test import TestCase
+
+from invoices.models import HourEntryChecksum
+from invoices.syncing.tenkfeet import upsert_checksums
+
+
+class UpsertChecksumsTest(TestCase):
+    def test_checksums_are_inserted_and_updated(self):
+        HourEntryChecksum.objects.create(date=datetime.date(2018, 1, 1), sha256="a" * 64)
+        HourEntryChecksum.objects.create(date=datetime.date(2018, 1, 2), sha256="b" * 64)
+        upsert_checksums([
+            HourEntryChecksum(date=datetime.date(2018, 1, 2), sha256="c" * 64),
+            HourEntryChecksum(date=datetime.date(2018, 1, 3), sha256="d" * 64),
+        ])
+        self.assertEqual(dict(HourEntryChecksum.objects.values_list("date", "sha256")), {
+            datetime.date(2018, 1, 1): "a" * 64,
+            datetime.date(2018, 1, 2): "c" * 64,
+            datetime.date(2018, 1, 3): "d" * 64,
+        })
+
+    def test_batches(self):
+        checksums = [HourEntryChecksum(date=datetime.date(2018, 1, 1) + datetime.timedelta(days=i), sha256=f"{i:064}") for i in range(1200)]
+        upsert_checksums(checksums[:700], batch_size=500)
+        upsert_checksums(checksums, batch_size=500)
+        self.assertEqual(HourEntryChecksum.objects.count(), 1200)
+        self.assertEqual(HourEntryChecksum.objects.get(date=datetime.date(2018, 1, 1) + datetime.timedelta(days=1199)).sha256, f"{1199:064}")
+
+    def test_no_checksums(self):
+        upsert_checksums([])
+        self.assertEqual(HourEntryChecksum.objects.count(), 0)
@@ -0,0 +1,161 @@
+import copy
+import datetime
+
+from django.test import SimpleTestCase
+from schema import And, Optional, Or, Schema, SchemaError, Use
+
+from invoices.compiled_schema import CompiledSchema
+from invoices.tenkfeet_api import TenkFeetApi
+from invoices.utils import parse_date, parse_datetime
+
+
+def opt(t):
+    return Or(type(None), t)
+
+
+ENTRY_SCHEMA = Schema([{
+    "id": int,
+    "billable": bool,
+    "hours": Use(float),
+    "date": Use(parse_date),
+    "email": opt(And(str, Use(str.lower))),
+    "notes": opt(str),
+    "tags": {
+        "data": [{"id": int, "value": str}],
+        "paging": {"next": opt(str), "page": int},
+    },
+}])
+
+
+def entry(**fields):
+    data = {
+        "id": 1,
+        "billable": True,
+        "hours": "7.5",
+        "date": "2018-02-01",
+        "email": "First.Last@example.com",
+        "notes": None,
+        "tags": {"data": [{"id": 2, "value": "First Last"}], "paging": {"next": None, "page": 1}},
+    }
+    data.update(fields)
+    return data
+
+
+def time_entry(**fields):
+    data = {
+        "id": 1,
+        "assignable_id": 2,
+        "assignable_type": "Project",
+        "user_id": 3,
+        "bill_rate": "100.0",
+        "bill_rate_id": None,
+        "date": "2018-02-01",
+        "hours": "7.5",
+        "scheduled_hours": "0",
+        "notes": "Notes",
+        "task": None,
+        "is_suggestion": False,
+        "created_at": "2018-02-01T10:00:00Z",
+        "updated_at": "2018-02-01T10:00:00Z",
+        "approvals": {
+            "data": [{
+                "id": 4,
+                "status": "approved",
+                "approvable_id": 1,
+                "approvable_type": "TimeEntry",
+                "submitted_by": 3,
+                "submitted_at": "2018-02-02T10:00:00Z",
+                "approved_by": 5,
+                "approved_at": "2018-02-03T10:00:00Z",
+                "created_at": "2018-02-02T10:00:00Z",
+                "updated_at": "2018-02-03T10:00:00Z",
+            }],
+            "paging": {"next": None, "page": 1, "per_page": 20, "previous": None, "self": "/api/v1/approvals?page=1"},
+        },
+    }
+    data.update(fields)
+    return data
+
+
+class CompiledSchemaTest(SimpleTestCase):
+    def assert_same_result(self, schema, data):
+        """Check that CompiledSchema returns the same data, or raises the same error, as Schema.validate"""
+        try:
+            expected = schema.validate(copy.deepcopy(data))
+        except SchemaError as error:
+            with self.assertRaises(SchemaError) as context:
+                CompiledSchema(schema).validate(copy.deepcopy(data))
+            self.assertEqual(str(context.exception), str(error))
+            return None
+        result = CompiledSchema(schema).validate(copy.deepcopy(data))
+        self.assertEqual(result, expected)
+        self.assertEqual(type(result), type(expected))
+        return result
+
+    def test_valid_data(self):
+        result = self.assert_same_result(ENTRY_SCHEMA, [entry(), entry(id=2, email=None, notes="Notes")])
+        self.assertEqual(result[0]["hours"], 7.5)
+        self.assertEqual(result[0]["date"], datetime.date(2018, 2, 1))
+        self.assertEqual(result[0]["email"], "first.last@example.com")
+
+    def test_empty_list(self):
+        self.assert_same_result(ENTRY_SCHEMA, [])
+
+    def test_wrong_types(self):
+        for data in (
+                entry(id="1"),
+                entry(billable=None),
+                entry(notes=1),
+                entry(email=1),
+                entry(tags={"data": [{"id": 2, "value": None}], "paging": {"next": None, "page": 1}}),
+                entry(tags={"data": {}, "paging": {"next": None, "page": 1}}),
+                entry(tags=None),
+        ):
+            self.assert_same_result(ENTRY_SCHEMA, [data])
+        self.assert_same_result(ENTRY_SCHEMA, entry())
+        self.assert_same_result(ENTRY_SCHEMA, [entry(), "entry"])
+
+    def test_failing_coercion(self):
+        self.assert_same_result(ENTRY_SCHEMA, [entry(hours="many")])
+        self.assert_same_result(ENTRY_SCHEMA, [entry(date="2018-13-01")])
+
+    def test_missing_and_extra_keys(self):
+        data = entry()
+        del data["notes"]
+        self.assert_same_result(ENTRY_SCHEMA, [data])
+        self.assert_same_result(ENTRY_SCHEMA, [entry(extra="value")])
+        self.assert_same_result(ENTRY_SCHEMA, [entry(tags={"data": [], "paging": {"page": 1}})])
+
+    def test_or_branches(self):
+        schema = Schema([Or(int, And(str, Use(int)), None)])
+        self.assert_same_result(schema, [1, "2", None])
+        self.assert_same_result(schema, [1, "two"])
+        self.assert_same_result(schema, [1.5])
+
+    def test_list_with_several_item_schemas(self):
+        schema = Schema([int, {"name": str}])
+        self.assert_same_result(schema, [1, {"name": "a"}, 2])
+        self.assert_same_result(schema, [1, {"name": 2}])
+
+    def test_optional_keys(self):
+        schema = Schema([{"id": int, Optional("notes"): opt(str)}])
+        self.assert_same_result(schema, [{"id": 1}, {"id": 2, "notes": None}, {"id": 3, "notes": "Notes"}])
+        self.assert_same_result(schema, [{"id": 1, "notes": 1}])
+        self.assert_same_result(schema, [{"notes": "Notes"}])
+
+    def test_ignore_extra_keys(self):
+        schema = Schema([Schema({"id": int}, ignore_extra_keys=True)])
+        self.assert_same_result(schema, [{"id": 1, "extra": "value"}])
+        self.assert_same_result(schema, [{"id": "1"}])
+
+    def test_custom_error(self):
+        schema = Schema([Schema({"id": int}, error="Invalid entry")])
+        self.assert_same_result(schema, [{"id": "1"}])
+
+    def test_tenkfeet_time_entries(self):
+        tenkfeet_schema = TenkFeetApi.TIME_ENTRIES_SCHEMA.schema
+        result = self.assert_same_result(tenkfeet_schema, [time_entry(), time_entry(id=2, approvals={"data": [], "paging": time_entry()["approvals"]["paging"]})])
+        self.assertEqual(result[0]["created_at"], parse_datetime("2018-02-01T10:00:00Z"))
+        self.assert_same_result(tenkfeet_schema, [time_entry(hours=None)])
+        self.assert_same_result(tenkfeet_schema, [time_entry(user_id=None)])
+        self.assert_same_result(tenkfeet_schema, [time_entry(approvals={"data": [], "paging": {}})])
@@ -0,0 +1,148 @@
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from django.test import TestCase
+
+from invoices.job_queue import MAX_MERGED_RANGE_LENGTH, claim_next_job, queue_job
+from invoices.locking import DistributedLock, get_date_range_lock_keys
+from invoices.models import QueuedJob
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def data_update(start_date, end_date, force=False):
+    data = {"type": "data-update", "start_date": start_date.strftime("%Y-%m-%d"), "end_date": end_date.strftime("%Y-%m-%d")}
+    if force:
+        data["force"] = True
+    return data
+
+
+def day(month, day_of_month):
+    return datetime.date(2018, month, day_of_month)
+
+
+class QueueDataUpdateTest(TestCase):
+    def assert_queued_ranges(self, expected):
+        self.assertEqual(list(QueuedJob.objects.filter(status="queued").order_by("id").values_list("start_date", "end_date")), expected)
+
+    def test_overlapping_ranges_are_merged(self):
+        job = queue_job(data_update(day(1, 1), day(1, 10)))
+        self.assertEqual(queue_job(data_update(day(1, 5), day(1, 20))), job)
+        self.assert_queued_ranges([(day(1, 1), day(1, 20))])
+        job.refresh_from_db()
+        self.assertEqual(job.merged_jobs, 1)
+        self.assertEqual(json.loads(job.data), {"type": "data-update", "force": False, "start_date": "2018-01-01", "end_date": "2018-01-20"})
+
+    def test_adjacent_ranges_are_merged(self):
+        queue_job(data_update(day(1, 1), day(1, 10)))
+        queue_job(data_update(day(1, 11), day(1, 20)))
+        self.assert_queued_ranges([(day(1, 1), day(1, 20))])
+
+    def test_separate_ranges_are_not_merged(self):
+        queue_job(data_update(day(1, 1), day(1, 10)))
+        queue_job(data_update(day(1, 12), day(1, 20)))
+        self.assert_queued_ranges([(day(1, 1), day(1, 10)), (day(1, 12), day(1, 20))])
+
+    def test_range_bridging_queued_jobs_merges_all_of_them(self):
+        first_job = queue_job(data_update(day(1, 1), day(1, 10)))
+        queue_job(data_update(day(1, 20), day(1, 31)))
+        queue_job(data_update(day(1, 11), day(1, 19)))
+        self.assert_queued_ranges([(day(1, 1), day(1, 31))])
+        first_job.refresh_from_db()
+        self.assertEqual(first_job.merged_jobs, 2)
+
+    def test_max_merged_range_length(self):
+        start_date = day(1, 1)
+        queue_job(data_update(start_date, start_date + MAX_MERGED_RANGE_LENGTH - datetime.timedelta(days=10)))
+        queue_job(data_update(start_date + MAX_MERGED_RANGE_LENGTH - datetime.timedelta(days=9), start_date + MAX_MERGED_RANGE_LENGTH))
+        self.assert_queued_ranges([(start_date, start_date + MAX_MERGED_RANGE_LENGTH)])
+
+        queue_job(data_update(start_date + MAX_MERGED_RANGE_LENGTH, start_date + MAX_MERGED_RANGE_LENGTH + datetime.timedelta(days=1)))
+        self.assert_queued_ranges([
+            (start_date, start_date + MAX_MERGED_RANGE_LENGTH),
+            (start_date + MAX_MERGED_RANGE_LENGTH, start_date + MAX_MERGED_RANGE_LENGTH + datetime.timedelta(days=1)),
+        ])
+
+    def test_force_is_kept_when_merging(self):
+        queue_job(data_update(day(1, 1), day(1, 10), force=True))
+        job = queue_job(data_update(day(1, 5), day(1, 15)))
+        self.assertTrue(json.loads(job.data)["force"])
+
+    def test_running_jobs_are_not_merged(self):
+        job = queue_job(data_update(day(1, 1), day(1, 10)))
+        QueuedJob.objects.filter(id=job.id).update(status="running")
+        self.assertNotEqual(queue_job(data_update(day(1, 5), day(1, 15))), job)
+        self.assert_queued_ranges([(day(1, 5), day(1, 15))])
+
+
+class QueueUniqueJobTest(TestCase):
+    def test_identical_jobs_are_deduplicated(self):
+        job = queue_job({"type": "unsubmitted-notification", "a": 1, "b": 2})
+        self.assertEqual(queue_job({"b": 2, "a": 1, "type": "unsubmitted-notification"}), job)
+        job.refresh_from_db()
+        self.assertEqual(job.merged_jobs, 1)
+        self.assertEqual(QueuedJob.objects.count(), 1)
+
+    def test_different_jobs_are_queued(self):
+        queue_job({"type": "unsubmitted-notification"})
+        queue_job({"type": "unapproved-notification"})
+        queue_job({"type": "unapproved-notification", "a": 1})
+        self.assertEqual(QueuedJob.objects.count(), 3)
+
+    def test_finished_jobs_are_not_reused(self):
+        job = queue_job({"type": "unsubmitted-notification"})
+        QueuedJob.objects.filter(id=job.id).update(status="done")
+        self.assertNotEqual(queue_job({"type": "unsubmitted-notification"}), job)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ClaimNextJobTest(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        patcher = mock.patch("invoices.locking.redis_client", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def claim(self):
+        claimed = claim_next_job()
+        if claimed:
+            job, lock = claimed
+            self.addCleanup(lock.release)
+            return job
+        return None
+
+    def test_oldest_job_is_claimed_first(self):
+        first_job = queue_job({"type": "unsubmitted-notification"})
+        second_job = queue_job(data_update(day(1, 1), day(1, 10)))
+        self.assertEqual(self.claim(), first_job)
+        self.assertEqual(self.claim(), second_job)
+        self.assertIsNone(self.claim())
+        self.assertEqual(QueuedJob.objects.filter(status="running").count(), 2)
+
+    def test_locked_jobs_are_left_to_the_queue(self):
+        locked_job = queue_job(data_update(day(1, 1), day(1, 10)))
+        other_job = queue_job(data_update(day(2, 1), day(2, 10)))
+        lock = DistributedLock(get_date_range_lock_keys(day(1, 10), day(1, 10)), redis_instance=self.redis)
+        self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+
+        self.assertEqual(self.claim(), other_job)
+        self.assertIsNone(self.claim())
+        locked_job.refresh_from_db()
+        self.assertEqual(locked_job.status, "queued")
+        self.assertIsNone(locked_job.started_at)
+
+        lock.release()
+        self.assertEqual(self.claim(), locked_job)
+
+    def test_notification_jobs_of_the_same_type_are_not_run_concurrently(self):
+        QueuedJob.objects.create(job_type="unsubmitted-notification", data="{}")
+        QueuedJob.objects.create(job_type="unsubmitted-notification", data="{}")
+        self.assertIsNotNone(self.claim())
+        self.assertIsNone(self.claim())
@@ -0,0 +1,220 @@
+import datetime
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import redis
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from invoices.job_queue import JOB_LEASE, get_job_lock_key, requeue_interrupted_jobs
+from invoices.locking import DistributedLock, LockLost, get_date_range_lock_keys, get_invoice_month_lock_keys
+from invoices.models import Client, HourEntryChecksum, Project, QueuedJob
+from invoices.syncing import tenkfeet
+from invoices.syncing.tenkfeet import HourEntryUpdate
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class LockKeysTest(SimpleTestCase):
+    def test_date_range_lock_keys(self):
+        self.assertEqual(get_date_range_lock_keys(datetime.date(2018, 1, 31), datetime.date(2018, 2, 1)), ["lock-hour-entries-2018-01-31", "lock-hour-entries-2018-02-01"])
+
+    def test_invoice_month_lock_keys(self):
+        self.assertEqual(get_invoice_month_lock_keys(datetime.date(2017, 12, 15), datetime.date(2018, 2, 1)), ["lock-invoice-stats-2017-12", "lock-invoice-stats-2018-01", "lock-invoice-stats-2018-02"])
+        self.assertEqual(get_invoice_month_lock_keys(datetime.date(2018, 1, 31), datetime.date(2018, 1, 31)), ["lock-invoice-stats-2018-01"])
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class DistributedLockTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    def lock(self, keys, **kwargs):
+        lock = DistributedLock(keys, redis_instance=self.redis, **kwargs)
+        self.addCleanup(lock.release)
+        return lock
+
+    def test_all_or_no_keys_are_acquired(self):
+        first_lock = self.lock(["a", "b"])
+        self.assertTrue(first_lock.acquire())
+        second_lock = self.lock(["b", "c"])
+        self.assertFalse(second_lock.acquire())
+        self.assertIsNone(self.redis.get("c"))
+        self.assertTrue(self.lock(["c"]).acquire())
+
+    def test_release(self):
+        lock = self.lock(["a", "b"])
+        self.assertTrue(lock.acquire())
+        lock.release()
+        self.assertFalse(self.redis.exists("a"))
+        self.assertFalse(self.redis.exists("b"))
+        self.assertTrue(self.lock(["a", "b"]).acquire())
+
+    def test_release_keeps_keys_held_by_others(self):
+        lock = self.lock(["a", "b"])
+        self.assertTrue(lock.acquire())
+        self.redis.set("b", "other")
+        lock.release()
+        self.assertFalse(self.redis.exists("a"))
+        self.assertEqual(self.redis.get("b"), b"other")
+
+    def test_renew_extends_the_lease(self):
+        lock = self.lock(["a"], lease=60)
+        self.assertTrue(lock.acquire())
+        self.redis.pexpire("a", 1000)
+        self.assertTrue(lock.renew())
+        self.assertGreater(self.redis.pttl("a"), 1000)
+
+    def test_lease_is_renewed_in_the_background(self):
+        heartbeats = []
+        lock = self.lock(["a"], lease=0.3, heartbeat=lambda: heartbeats.append(time.monotonic()))
+        self.assertTrue(lock.acquire())
+        time.sleep(0.6)
+        self.assertTrue(self.redis.exists("a"))
+        self.assertGreaterEqual(len(heartbeats), 2)
+        lock.check()
+
+    def test_check_raises_if_keys_were_taken(self):
+        lock = self.lock(["a", "b"])
+        self.assertTrue(lock.acquire())
+        lock.check()
+        self.redis.set("b", "other")
+        with self.assertRaises(LockLost):
+            lock.check()
+        self.assertTrue(lock.lost)
+
+    def test_check_raises_if_keys_expired(self):
+        lock = self.lock(["a"])
+        self.assertTrue(lock.acquire())
+        self.redis.delete("a")
+        with self.assertRaises(LockLost):
+            lock.check()
+
+    def test_check_raises_if_lease_was_not_renewed_in_time(self):
+        lock = self.lock(["a"])
+        self.assertTrue(lock.acquire())
+        lock.renewed_at -= lock.lease
+        with self.assertRaises(LockLost):
+            lock.check()
+
+    def test_lock_is_lost_if_renewing_fails(self):
+        heartbeats = []
+        lock = self.lock(["a"], lease=0.3, heartbeat=lambda: heartbeats.append(time.monotonic()))
+        self.assertTrue(lock.acquire())
+        with mock.patch.object(lock, "renew", side_effect=redis.ConnectionError("Redis is unavailable")):
+            time.sleep(0.6)
+            self.assertTrue(lock.lost)
+        heartbeat_count = len(heartbeats)
+        time.sleep(0.2)
+        # Heartbeats continue, so the job is not queued again while this process is still running it.
+        self.assertGreater(len(heartbeats), heartbeat_count)
+        with self.assertRaises(LockLost):
+            lock.check()
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class HourEntryUpdateLockTest(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        client = Client.objects.create(name="Solinor")
+        Project.objects.create(guid=uuid.uuid4(), project_id=1, project_state="Internal", name="[Leave Type]", client_m=client, created_at=timezone.now())
+        HourEntryChecksum.objects.create(date=datetime.date(2018, 1, 1), sha256="a" * 64)
+
+    def get_update(self):
+        update = HourEntryUpdate(datetime.date(2018, 1, 1), datetime.date(2018, 1, 2), staging=False)
+        update.now = timezone.now()
+        update.first_entry = datetime.date(2018, 1, 1)
+        update.last_entry = datetime.date(2018, 1, 2)
+        update.delete_days = {datetime.date(2018, 1, 1), datetime.date(2018, 1, 2)}
+        update.checksum_updates = [
+            HourEntryChecksum(date=datetime.date(2018, 1, 1), sha256="b" * 64),
+            HourEntryChecksum(date=datetime.date(2018, 1, 2), sha256="c" * 64),
+        ]
+        return update
+
+    def get_lock(self):
+        lock = DistributedLock(get_date_range_lock_keys(datetime.date(2018, 1, 1), datetime.date(2018, 1, 2)), redis_instance=self.redis)
+        self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+        return lock
+
+    def assert_checksums(self, expected):
+        self.assertEqual(dict(HourEntryChecksum.objects.values_list("date", "sha256")), expected)
+
+    def test_write_with_lock(self):
+        self.get_update().write(lock=self.get_lock())
+        self.assert_checksums({datetime.date(2018, 1, 1): "b" * 64, datetime.date(2018, 1, 2): "c" * 64})
+
+    def test_write_is_not_started_if_lock_was_lost(self):
+        lock = self.get_lock()
+        self.redis.set("lock-hour-entries-2018-01-02", "other")
+        with self.assertRaises(LockLost):
+            self.get_update().write(lock=lock)
+        self.assert_checksums({datetime.date(2018, 1, 1): "a" * 64})
+
+    def test_write_is_rolled_back_if_lock_is_lost_during_the_transaction(self):
+        lock = self.get_lock()
+        upsert_checksums = tenkfeet.upsert_checksums
+
+        def upsert_and_lose_lock(*args, **kwargs):
+            upsert_checksums(*args, **kwargs)
+            self.redis.set("lock-hour-entries-2018-01-02", "other")
+
+        with mock.patch("invoices.syncing.tenkfeet.upsert_checksums", upsert_and_lose_lock):
+            with self.assertRaises(LockLost):
+                self.get_update().write(lock=lock)
+        self.assert_checksums({datetime.date(2018, 1, 1): "a" * 64})
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RequeueInterruptedJobsTest(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        patcher = mock.patch("invoices.locking.redis_client", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.expired = timezone.now() - datetime.timedelta(seconds=JOB_LEASE + 1)
+
+    def create_running_job(self, started_at, heartbeat_at):
+        return QueuedJob.objects.create(job_type="unsubmitted-notification", data="{}", status="running", started_at=started_at, heartbeat_at=heartbeat_at)
+
+    def assert_status(self, job, status):
+        job.refresh_from_db()
+        self.assertEqual(job.status, status)
+
+    def test_jobs_without_heartbeat_or_lock_are_requeued(self):
+        job = self.create_running_job(self.expired, self.expired)
+        self.assertEqual(requeue_interrupted_jobs(), 1)
+        self.assert_status(job, "queued")
+        self.assertIsNone(job.started_at)
+        self.assertIsNone(job.heartbeat_at)
+
+    def test_jobs_claimed_before_heartbeats_are_requeued(self):
+        job = self.create_running_job(self.expired, None)
+        self.assertEqual(requeue_interrupted_jobs(), 1)
+        self.assert_status(job, "queued")
+
+    def test_jobs_with_recent_heartbeat_are_not_requeued(self):
+        # The lock has expired, but the worker is still running the job.
+        job = self.create_running_job(self.expired, timezone.now())
+        self.assertEqual(requeue_interrupted_jobs(), 0)
+        self.assert_status(job, "running")
+
+    def test_locked_jobs_are_not_requeued(self):
+        job = self.create_running_job(self.expired, self.expired)
+        self.redis.set(get_job_lock_key(job.id), "worker")
+        self.assertEqual(requeue_interrupted_jobs(), 0)
+        self.assert_status(job, "running")
+
+    def test_finished_jobs_are_not_requeued(self):
+        job = QueuedJob.objects.create(job_type="unsubmitted-notification", data="{}", status="done", started_at=self.expired, heartbeat_at=self.expired)
+        self.assertEqual(requeue_interrupted_jobs(), 0)
+        self.assert_status(job, "done")
@@ -0,0 +1,177 @@
+import datetime
+import json
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from invoices.models import SlackNotification
+from invoices.slack_delivery import SENDING_TIMEOUT, SlackDelivery, expire_stale_sending_notifications
+
+
+class FakeSlackServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Local stand-in for the Slack API
+
+    Responses are scripted per channel: each call to a channel pops the next (status, headers, body, delay) from responses[channel]. Once the script runs out, calls succeed. All calls are recorded to `calls` as (time, channel).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSlackHandler)
+        self.responses = defaultdict(list)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/"
+
+    def calls_for(self, channel):
+        return [called_at for called_at, called_channel in self.calls if called_channel == channel]
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint:disable=invalid-name
+        data = urllib.parse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        channel = data["channel"][0]
+        with self.server.lock:
+            self.server.calls.append((time.monotonic(), channel))
+            script = self.server.responses[channel]
+            status, headers, body, delay = script.pop(0) if script else (200, {}, {"ok": True, "ts": str(len(self.server.calls))}, 0)
+        time.sleep(delay)
+        try:
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+        except BrokenPipeError:
+            pass  # The client timed out
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+
+def get_unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SlackDeliveryTest(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeSlackServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.delivery = SlackDelivery(token="test-token", api_url=self.server.api_url, workers=4, max_retries=3, backoff=0.01, timeout=1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_messages_are_sent(self):
+        messages = [self.delivery.post_message(f"C{i}", text="Hello") for i in range(5)]
+        self.assertEqual(self.delivery.deliver(), messages)
+        for message in messages:
+            self.assertEqual(message.status, "sent")
+            self.assertEqual(message.attempts, 1)
+            self.assertIsNotNone(message.ts)
+
+    def test_retry_after_is_honoured(self):
+        self.server.responses["C1"].append((429, {"Retry-After": "1"}, {"ok": False, "error": "ratelimited"}, 0))
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "sent")
+        self.assertEqual(message.attempts, 2)
+        first_call, second_call = self.server.calls_for("C1")
+        self.assertGreaterEqual(second_call - first_call, 1)
+
+    def test_ratelimited_error_is_retried(self):
+        self.server.responses["C1"].append((200, {}, {"ok": False, "error": "ratelimited"}, 0))
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "sent")
+        self.assertEqual(message.attempts, 2)
+
+    def test_retries_are_limited(self):
+        self.server.responses["C1"].extend([(429, {"Retry-After": "0"}, {"ok": False, "error": "ratelimited"}, 0)] * 5)
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "failed")
+        self.assertEqual(message.attempts, 3)
+        self.assertEqual(len(self.server.calls_for("C1")), 3)
+
+    def test_server_error_is_not_retried(self):
+        # Slack may have posted the message before failing, so retrying could post it twice.
+        self.server.responses["C1"].append((500, {}, {}, 0))
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "unknown")
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(len(self.server.calls_for("C1")), 1)
+
+    def test_read_timeout_is_not_retried(self):
+        self.server.responses["C1"].append((200, {}, {"ok": True, "ts": "1"}, 1.5))
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "unknown")
+        self.assertEqual(message.attempts, 1)
+
+    def test_refused_connection_is_retried(self):
+        delivery = SlackDelivery(token="test-token", api_url=f"http://127.0.0.1:{get_unused_port()}/api/", max_retries=2, backoff=0.01)
+        message = delivery.post_message("C1", text="Hello")
+        delivery.deliver()
+        self.assertEqual(message.status, "failed")
+        self.assertEqual(message.attempts, 2)
+
+    def test_slack_errors_are_final(self):
+        self.server.responses["C1"].append((200, {}, {"ok": False, "error": "channel_not_found"}, 0))
+        message = self.delivery.post_message("C1", text="Hello")
+        self.delivery.deliver()
+        self.assertEqual(message.status, "failed")
+        self.assertEqual(message.error, "channel_not_found")
+        self.assertEqual(message.attempts, 1)
+
+    def test_each_message_gets_its_own_outcome(self):
+        self.server.responses["C2"].append((200, {}, {"ok": False, "error": "channel_not_found"}, 0))
+        self.server.responses["C3"].append((502, {}, {}, 0))
+        self.server.responses["C4"].append((429, {"Retry-After": "0"}, {"ok": False, "error": "ratelimited"}, 0))
+        messages = [self.delivery.post_message(f"C{i}", text="Hello") for i in range(1, 5)]
+        self.delivery.deliver()
+        self.assertEqual([(message.status, message.attempts) for message in messages], [("sent", 1), ("failed", 1), ("unknown", 1), ("sent", 2)])
+        self.assertEqual([message.error for message in messages], [None, "channel_not_found", "HTTP 502", None])
+
+    def test_channel_rate_limit(self):
+        for _ in range(3):
+            self.delivery.post_message("C1", text="Hello")
+        self.delivery.post_message("C2", text="Hello")
+        self.delivery.deliver()
+        calls = self.server.calls_for("C1")
+        self.assertEqual(len(calls), 3)
+        for previous_call, call in zip(calls, calls[1:]):
+            self.assertGreaterEqual(call - previous_call, 0.9 / SlackDelivery.CHANNEL_RATE_LIMIT)
+        # Other channels are not blocked by the first one.
+        self.assertLess(self.server.calls_for("C2")[0] - calls[0], 0.5)
+
+
+class ExpireStaleSendingNotificationsTest(TestCase):
+    def create_notification(self, key, status, claimed_at):
+        return SlackNotification.objects.create(idempotency_key=key, notification_type="test", channel="C1", text="Hello", status=status, claimed_at=claimed_at)
+
+    def test_stale_sending_notifications_are_moved_to_unknown(self):
+        now = timezone.now()
+        stale = self.create_notification("stale", "sending", now - SENDING_TIMEOUT - datetime.timedelta(minutes=1))
+        unclaimed = self.create_notification("unclaimed", "sending", None)
+        fresh = self.create_notification("fresh", "sending", now)
+        pending = self.create_notification("pending", "pending", None)
+        self.assertEqual(expire_stale_sending_notifications(), 2)
+        for notification, status in ((stale, "unknown"), (unclaimed, "unknown"), (fresh, "sending"), (pending, "pending")):
+            notification.refresh_from_db()
+            self.assertEqual(notification.status, status)
@@ -2,6 +2,7 @@ import calendar
 import datetime
 import logging
 
+from django.db.models import Case, F, Value, When
 from django.utils.dateparse import parse_date as parse_date_django
 from django.utils.dateparse import parse_datetime as parse_datetime_django
 
@@ -39,3 +40,19 @@ def month_end_date(year, month):
 def daterange(start_date, end_date):
     for day_count in range(int((end_date - start_date).days) + 1):
         yield start_date + datetime.timedelta(day_count)
+
+
+def bulk_update(model, rows, fields, batch_size=100):
+    """Update different values to multiple rows with one UPDATE statement per batch
+
+    rows is {primary key: {field name: value}}, and each row must have a value for each of the fields. Django 2.0 has no QuerySet.bulk_update, so this builds CASE WHEN expressions for each field.
+    """
+    pk_name = model._meta.pk.name
+    rows = list(rows.items())
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        updates = {}
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            updates[field_name] = Case(*[When(**{pk_name: pk, "then": Value(values[field_name], output_field=field)}) for pk, values in batch], default=F(field_name), output_field=field)
+        model.objects.filter(**{f"{pk_name}__in": [pk for pk, _ in batch]}).update(**updates)
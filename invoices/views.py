@@ -28,6 +28,7 @@ from invoices.hours.file_exports import generate_hours_pdf_for_invoice, generate
 from invoices.hours.sickleaves import get_early_care_sickleaves
 from invoices.hours.stats import calculate_clientbase_stats, hours_overview_stats
 from invoices.invoice_utils import calculate_entry_stats, generate_amazon_invoice_data, get_aws_entries
+from invoices.job_queue import queue_job
 from invoices.models import (AmazonInvoiceRow, AmazonLinkedAccount, Client, Comments, DataUpdate, Event, HourEntry,
                              Invoice, InvoiceFixedEntry, Project, ProjectFixedEntry, SlackNotificationBundle, TenkfUser)
 from invoices.syncing.slack import sync_slack_channels, sync_slack_users
@@ -316,9 +317,9 @@ def queue_slack_notification(request):
             return HttpResponseBadRequest()
         start_date = datetime.datetime.strptime(request.POST.get("start_date"), "%Y-%m-%d") if request.POST.get("start_date") else start_date
         end_date = datetime.datetime.strptime(request.POST.get("end_date"), "%Y-%m-%d") if request.POST.get("end_date") else end_date
-        REDIS.publish("request-refresh", json.dumps({"type": f"slack-{notification_type}-notification",
-                                                     "start_date": start_date.strftime("%Y-%m-%d"),
-                                                     "end_date": end_date.strftime("%Y-%m-%d")}))
+        queue_job({"type": f"slack-{notification_type}-notification",
+                   "start_date": start_date.strftime("%Y-%m-%d"),
+                   "end_date": end_date.strftime("%Y-%m-%d")})
 
         messages.add_message(request, messages.INFO, f"Slack notifications for {notification_type} queued.")
         return HttpResponseRedirect(return_url)
@@ -365,7 +366,7 @@ def queue_update(request):
                 return HttpResponseRedirect(return_url)
         except DataUpdate.DoesNotExist:
             pass
-        REDIS.publish("request-refresh", json.dumps({"type": "data-update", "start_date": start_date.strftime("%Y-%m-%d"), "end_date": end_date.strftime("%Y-%m-%d")}))
+        queue_job({"type": "data-update", "start_date": start_date.strftime("%Y-%m-%d"), "end_date": end_date.strftime("%Y-%m-%d")})
         update_obj = DataUpdate()
         update_obj.save()
         messages.add_message(request, messages.INFO, "Update queued. This is normally finished within 10 seconds. Refresh the page to see new data.")
@@ -430,7 +431,7 @@ def your_unsubmitted_hours(request):
                     "start_date": start_date.strftime("%Y-%m-%d"),
                     "end_date": end_date.strftime("%Y-%m-%d"),
                 }
-                REDIS.publish("request-refresh", json.dumps(update_data))
+                queue_job(update_data)
                 messages.add_message(request, messages.INFO, "Hours submitted and update queued - updating this page will take a few moments (usually <10s, but in some rare cases up to 30 minutes)")
             else:
                 messages.add_message(request, messages.INFO, "Hours submitted. Data entry was not queued, as entries are spread over 6 months period.")
@@ -0,0 +1 @@
+default_app_config = "slack_hooks.apps.SlackHooksConfig"  # pylint:disable=invalid-name
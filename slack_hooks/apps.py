@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SlackHooksConfig(AppConfig):
     name = 'slack_hooks'
+
+    def ready(self):
+        import slack_hooks.signals  # pylint:disable=unused-variable
@@ -0,0 +1,26 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from invoices.models import Invoice, Project
+from slack_hooks.utils import invalidate_unfurls
+
+
+@receiver(post_save, sender=Invoice)
+@receiver(post_delete, sender=Invoice)
+def invalidate_invoice_unfurls(sender, instance, **kwargs):  # pylint:disable=unused-argument
+    invalidate_unfurls(invoice_ids=[instance.invoice_id], project_guids=[instance.project_m_id])
+
+
+@receiver(post_save, sender=Project)
+def invalidate_project_unfurls(sender, instance, **kwargs):  # pylint:disable=unused-argument
+    invalidate_unfurls(project_guids=[instance.guid])
+
+
+@receiver(m2m_changed, sender=Project.admin_users.through)
+def invalidate_project_admin_unfurls(sender, instance, action, reverse, pk_set, **kwargs):  # pylint:disable=unused-argument,too-many-arguments
+    if not action.startswith("post_"):
+        return
+    if reverse:
+        invalidate_unfurls(project_guids=pk_set or [])
+    else:
+        invalidate_unfurls(project_guids=[instance.guid])
@@ -0,0 +1,305 @@
+"""
+Slack link unfurls.
+
+Slack expects the event callback to be acknowledged within three seconds, so incoming_event only queues the event, and the unfurls are built and sent by the background worker (process_update_queue).
+"""
+import datetime
+import json
+import logging
+import re
+import urllib.parse
+
+import redis
+import requests
+import slacker
+from django.conf import settings
+from django.db.models import Q
+from django.urls import reverse
+
+from flex_hours.utils import HOLIDAYS_VERSION_KEY, FlexHourException, FlexNotEnabledException, get_cached_flex_saldo
+from invoices.job_queue import queue_job
+from invoices.models import Invoice, Project, TenkfUser
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+slack = slacker.Slacker(settings.SLACK_WORKSPACE_ACCESS_TOKEN)  # pylint:disable=invalid-name
+redis_client = redis.from_url(settings.REDIS)  # pylint:disable=invalid-name
+
+SLACK_EVENT_DEDUPLICATION_TIMEOUT = 60 * 60  # Slack retries failed events for a few minutes - this is plenty.
+UNFURL_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_slack_flex_response(person, ephemeral=True, data=None):
+    if data is None:
+        data = get_cached_flex_saldo(person, only_active=True)
+    elif isinstance(data, FlexHourException):
+        raise data
+    if not data.get("active", True):
+        raise FlexNotEnabledException()
+    message = "Flex saldo for {} is {:+.2f}h".format(person.full_name, data["cumulative_saldo"])
+    if len(data["monthly_summary"]) > 1:
+        change_since_last_month = "{:+.2f}h".format(data["cumulative_saldo"] - data["monthly_summary"][1]["cumulative_saldo"])
+    else:
+        change_since_last_month = "--"
+    attachment = {
+        "fields": [
+            {
+                "short": True,
+                "title": "Flex",
+                "value": "{:+.2f}h".format(data["cumulative_saldo"]),
+            },
+            {
+                "short": True,
+                "title": "KIKY deduction",
+                "value": "{:+.2f}h".format(data.get("kiky", {}).get("saldo", "?")),
+            },
+            {
+                "short": True,
+                "title": "Change from last month",
+                "value": change_since_last_month,
+            },
+        ],
+        "actions": [
+            {
+                "type": "button",
+                "style": "primary",
+                "text": "View details",
+                "url": "https://{}{}".format(settings.DOMAIN, reverse("person_flex_hours", args=(person.guid,))),
+            },
+            {
+                "type": "button",
+                "text": "10000ft",
+                "url": "https://app.10000ft.com",
+            },
+        ],
+    }
+    return message, attachment
+
+
+def get_flex_saldo_command_response(person, data=None):
+    """Return response for /flex slash command. data is a precalculated flex saldo, if available"""
+    try:
+        message, attachment = get_slack_flex_response(person, data=data)
+    except FlexNotEnabledException:
+        return {
+            "response_type": "ephemeral",
+            "text": "It seems you don't have flex saldo activated right now.",
+        }
+    except FlexHourException as error:
+        logger.error("Unable to calculate flex saldo for %s: %s", person, error)
+        return {
+            "response_type": "ephemeral",
+            "text": "Sorry, unable to calculate your flex saldo right now.",
+        }
+    return {
+        "response_type": "ephemeral",
+        "text": message,
+        "attachments": [
+            attachment
+        ],
+    }
+
+
+def queue_flex_saldo_command_response(person, response_url):
+    queue_job({"type": "slack-flex-saldo-response", "user_guid": str(person.guid), "response_url": response_url})
+
+
+def process_flex_saldo_command_response(user_guid, response_url):
+    """Calculate flex saldo and send it as a delayed response to /flex slash command"""
+    person = TenkfUser.objects.get(guid=user_guid)
+    response = get_flex_saldo_command_response(person)
+    try:
+        requests.post(response_url, json=response, timeout=10).raise_for_status()
+    except requests.RequestException as error:
+        logger.error("Unable to send flex saldo response to %s: %s", response_url, error)
+
+
+def queue_unfurl_event(event_id, event):
+    """Queue unfurling links in a Slack event to the background worker
+
+    Slack retries events that were not acknowledged in time, so each event_id is queued only once. Returns False for duplicates.
+    """
+    if event_id and not redis_client.set(f"slack-event-{event_id}", 1, nx=True, ex=SLACK_EVENT_DEDUPLICATION_TIMEOUT):
+        logger.info("Skipping duplicate Slack event %s", event_id)
+        return False
+    queue_job({"type": "slack-unfurl", "event_id": event_id, "event": event})
+    return True
+
+
+def invalidate_unfurls(invoice_ids=(), project_guids=()):
+    """Bump unfurl versions for given invoices and projects, making their cached unfurls stale"""
+    pipe = redis_client.pipeline(transaction=False)
+    for invoice_id in invoice_ids:
+        pipe.incr(f"unfurl-version-invoice-{invoice_id}")
+    for project_guid in project_guids:
+        pipe.incr(f"unfurl-version-project-{project_guid}")
+    pipe.execute()
+
+
+def get_unfurl_versions(version_keys):
+    return [version.decode() if version else None for version in redis_client.mget(version_keys)]
+
+
+def get_cached_unfurl(cache_key, build_unfurl, *args):
+    """Return an unfurl from the cache, or build and cache it with build_unfurl(*args)
+
+    build_unfurl returns (unfurl, version_keys). The cached unfurl is used only if none of the version keys changed since it was built. Unfurls without version keys (for example, for missing objects) are not cached.
+    """
+    cached = redis_client.get(cache_key)
+    if cached:
+        cached = json.loads(cached.decode())
+        if get_unfurl_versions(cached["version_keys"]) == cached["versions"]:
+            return cached["unfurl"]
+    unfurl, version_keys = build_unfurl(*args)
+    if version_keys:
+        redis_client.set(cache_key, json.dumps({"version_keys": version_keys, "versions": get_unfurl_versions(version_keys), "unfurl": unfurl}), ex=UNFURL_CACHE_TIMEOUT)
+    return unfurl
+
+
+def get_flex_unfurl(person_guid):
+    try:
+        person = TenkfUser.objects.get(guid=person_guid)
+    except TenkfUser.DoesNotExist:
+        return {"text": "404 - User does not exist"}, []
+    version_keys = [f"flex-version-{person.guid}", HOLIDAYS_VERSION_KEY]
+    try:
+        message, attachment = get_slack_flex_response(person)
+    except FlexNotEnabledException:
+        return {"text": f"Flex saldo is not enabled for {person.full_name}."}, version_keys
+    attachment["text"] = message
+    attachment["is_app_unfurl"] = True
+    return attachment, version_keys
+
+
+def get_invoice_unfurl(invoice_id):
+    try:
+        invoice = Invoice.objects.select_related("project_m", "project_m__client_m").get(invoice_id=invoice_id)
+    except Invoice.DoesNotExist:
+        return {"text": "404 - this invoice does not exist"}, []
+    tags = ", ".join([user.full_name for user in invoice.admin_users()])
+    unfurl = {
+        "title": f"Solinor Invoice - {invoice.full_name} - {invoice.formatted_date}",
+        "fields": [
+            {
+                "title": "Invoice state",
+                "short": True,
+                "value": invoice.get_invoice_state_display(),
+            },
+            {
+                "title": "Tags",
+                "short": True,
+                "value": tags or "-",
+            },
+            {
+                "title": "Incurred hours",
+                "short": True,
+                "value": f"{invoice.incurred_hours:.2f}h",
+            },
+            {
+                "title": "Incurred billing",
+                "short": True,
+                "value": f"{invoice.incurred_money:.2f}€",
+            },
+            {
+                "title": "Incorrect hour entries",
+                "short": True,
+                "value": invoice.incorrect_entries_count,
+            },
+        ],
+    }
+    return unfurl, [f"unfurl-version-invoice-{invoice.invoice_id}", f"unfurl-version-project-{invoice.project_m_id}"]
+
+
+def get_project_unfurl(project_guid):
+    try:
+        project = Project.objects.select_related("client_m").get(guid=project_guid)
+    except Project.DoesNotExist:
+        return {"text": "404 - project does not exist"}, []
+    invoices = Invoice.objects.filter(project_m=project).exclude(Q(incurred_hours=0) & Q(incurred_money=0)).order_by("-date")
+    message = ""
+    if project.description:
+        message += project.description + "\n\n"
+    total_incurred_hours = total_incurred_billing = 0
+    if len(invoices):
+        for invoice in invoices:
+            total_incurred_hours += invoice.incurred_hours
+            total_incurred_billing += invoice.incurred_money
+
+        for c, invoice in enumerate(invoices):
+            if c > 12:
+                message += "..."
+                break
+            message += "- <https://{}{}|{} - {:.2f}h - {:.2f}€ - {}>\n".format(settings.DOMAIN, reverse("invoice", args=(invoice.invoice_id,)), invoice.formatted_date, invoice.incurred_hours, invoice.incurred_money, invoice.get_invoice_state_display())
+    else:
+        message += "No invoices."
+    unfurl = {
+        "title": f"Solinor project - {project.full_name}",
+        "text": message,
+        "mrkdwn_in": ["text"],
+        "fields": [
+            {
+                "title": "Start date",
+                "value": f"{project.starts_at:%Y-%m-%d}",
+                "short": True,
+            },
+            {
+                "title": "End date",
+                "value": f"{project.ends_at:%Y-%m-%d}",
+                "short": True,
+            },
+            {
+                "title": "Incurred hours",
+                "value": f"{total_incurred_hours:.2f}h",
+                "short": True,
+            },
+            {
+                "title": "Incurred billing",
+                "value": f"{total_incurred_billing:.2f}€",
+                "short": True,
+            },
+            {
+                "title": "Project state",
+                "value": project.project_state,
+                "short": True,
+            },
+        ],
+    }
+    return unfurl, [f"unfurl-version-project-{project.guid}"]
+
+
+def with_title_link(unfurl, url):
+    if "title" in unfurl:
+        return dict(unfurl, title_link=url)
+    return unfurl
+
+
+def get_unfurls(links):
+    """Build unfurls for links, using cached unfurls when available"""
+    unfurls = {}
+    today = datetime.date.today()
+    for link in links:
+        split_url = urllib.parse.urlsplit(link["url"])
+        flex_hours_path = re.match(r"^/users/([a-z0-9-]+)/flexhours", split_url.path)
+        if flex_hours_path:
+            # Flex saldo changes every day even without new hour markings.
+            unfurls[link["url"]] = get_cached_unfurl(f"unfurl-flex-{flex_hours_path.group(1)}-{today:%Y-%m-%d}", get_flex_unfurl, flex_hours_path.group(1))
+            continue
+
+        invoice_url = re.match(r"^/invoices/([a-z0-9-]+)$", split_url.path)
+        if invoice_url:
+            unfurls[link["url"]] = with_title_link(get_cached_unfurl(f"unfurl-invoice-{invoice_url.group(1)}", get_invoice_unfurl, invoice_url.group(1)), link["url"])
+            continue
+
+        projects_url = re.match(r"^/projects/([a-z0-9-]+)$", split_url.path)
+        if projects_url:
+            unfurls[link["url"]] = with_title_link(get_cached_unfurl(f"unfurl-project-{projects_url.group(1)}", get_project_unfurl, projects_url.group(1)), link["url"])
+    return unfurls
+
+
+def process_unfurl_event(event):
+    unfurls = get_unfurls(event.get("links", []))
+    if unfurls:
+        logger.info("Unfurl request: %s", unfurls)
+        try:
+            slack.chat.unfurl(event["channel"], event["message_ts"], json.dumps(unfurls))
+        except slacker.Error as err:
+            logger.error("An error occurred while unfurling: request=%s, response=%s", unfurls, err)